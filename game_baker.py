@@ -31,8 +31,31 @@ bl_info = {
 
 import bpy
 import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import struct
+import zlib
+import hashlib
+import threading
+import bisect
+import inspect
+from functools import reduce, wraps
 import colorsys
 import random
+import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from bpy.app.handlers import persistent
+try:
+    import resource
+except ImportError: #Windows
+    resource = None
 from bpy.props import (
         StringProperty,
         BoolProperty,
@@ -43,10 +66,46 @@ from bpy.props import (
         )
 
 BAKE = False
-BAKEIMG = None
-LASTIMG = None
-BAKELIST = []
-BAKING = False
+MESH_BOUNDS = {}
+CAGES = {} #Lowpoly name: cage object name, cages kept in sync with their lowpoly
+APPLIED_SETTINGS = {} #Bake settings function: arguments it last applied, kept while a queue runs
+BAKE_MATERIALS = OrderedDict()
+BAKE_MATERIAL_LIMIT = 16
+BAKE_MATERIALS_IN_USE = set() #Keys of the bake in progress, never evicted until it's done
+BAKE_IMAGES = {}
+BAKE_IMAGES_COUNT = None
+EXPORT_THREADS = min(8, os.cpu_count() or 1)
+STREAM_BACKLOG = 2 #Finished files a streaming bake keeps waiting for the writer
+STREAM_PROXY_SIZE = 64 #Side of the image left in memory once its bake is on disk
+TILE_ROWS = 256 #Rows of the stitched image converted at a time
+TILE_BYTES_PER_PIXEL = 96 #Tile image plus the Cycles bake pixel and result buffers, roughly
+RASTER_CHUNK = 1 << 22 #Candidate texels tested per rasterizer batch
+PROJECT_RAY_LIMIT = 1 << 18 #High poly rays per geometry bake, larger maps project a coarser grid
+DDS_BLOCK_BATCH = 1 << 14 #4x4 blocks compressed per batch
+MIP_KAISER_ALPHA = 4.0
+CAGE_RAY_BATCH = 4096 #Lowpoly vertices converted for ray casting at a time
+CAGE_MAX_LAYERS = 8 #Highpoly surfaces a cage ray steps through looking for the outermost
+TRACE_EVENTS = None #List of Chrome trace events while tracing, None when off
+TRACE_START = 0.0
+
+LUMA = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+ENGINE_ITEMS = [
+    ('CYCLES', 'Cycles', 'Render the map with a Cycles bake'),
+    ('GEOMETRY', 'Geometry', 'Compute the map from mesh data, without rendering')
+]
+
+IMAGE_FORMATS = [
+    ('PNG', 'PNG', ''),
+    ('TARGA', 'TGA', ''),
+    ('TARGA_RAW', 'TGA(RAW)', ''),
+    ('BMP', 'BMP', ''),
+    ('TIFF', 'TIFF', ''),
+    ('JPEG', 'JPG', ''),
+    ('DPX', 'DPX', ''),
+    ('OPEN_EXR', 'OpenEXR', ''),
+    ('DDS', 'DDS', 'Block compressed: BC5 normals, BC4 grayscale maps, BC1 colour maps, with mipmaps')
+]
 
 AO_QUALITY_SAMPLES = {
     'LOW': 32,
@@ -55,6 +114,8 @@ AO_QUALITY_SAMPLES = {
     'VHIGH': 1024
 }
 
+AO_FIRST_ROUND_SAMPLES = 32
+
 DIF_QUALITY_SAMPLES = {
     'LOW': 32,
     'MID': 128,
@@ -62,6 +123,78 @@ DIF_QUALITY_SAMPLES = {
     'VHIGH': 1024
 }
 
+COMMON_HASH_PROPS = [
+    'bake_width',
+    'bake_height',
+    'render.bake.margin',
+    'render.bake.use_selected_to_active',
+    'render.bake.use_cage',
+    'render.bake.cage_extrusion',
+    'render.bake.cage_object',
+    'cycles.device'
+]
+
+RECIPE_HASH_PROPS = {
+    'AO': ['ao_quality', 'denoise_bakes', 'denoise_radius', 'denoise_sigma',
+           'ao_adaptive', 'ao_noise_target', 'ao_time_budget', 'world.light_settings.distance'],
+    'DIFFUSE': ['dif_quality'],
+    'NORMAL': ['engine_type', 'render.bake.normal_space', 'normal_variants', 'normal_to_tangent', 'normal_depth',
+               'normal_swizzle_r', 'normal_swizzle_g', 'normal_swizzle_b'],
+    'CURVE': ['curvature_engine'],
+    'POS': ['bake_pos_x', 'bake_pos_y', 'bake_pos_z', 'position_engine'],
+    'ID': ['bake_id_type', 'bake_id_color', 'id_engine'],
+    'PACK': ['pack_output', 'gamebake_curvature', 'gamebake_position', 'gamebake_id',
+             'curvature_engine', 'position_engine', 'id_engine',
+             'bake_pos_x', 'bake_pos_y', 'bake_pos_z', 'bake_id_type', 'bake_id_color']
+}
+
+ENGINE_SWIZZLES = {
+    'UNITY': ('POS_X', 'POS_Y', 'POS_Z'),
+    'UNREAL': ('POS_X', 'NEG_Y', 'POS_Z')
+}
+
+SWIZZLE_ITEMS = [
+    ('POS_X', '+X', ''),
+    ('POS_Y', '+Y', ''),
+    ('POS_Z', '+Z', ''),
+    ('NEG_X', '-X', ''),
+    ('NEG_Y', '-Y', ''),
+    ('NEG_Z', '-Z', '')
+]
+
+PACK_CHANNELS = [
+    ('R', 'CURVE'),
+    ('G', 'POS'),
+    ('B', 'ID')
+]
+
+NOISY_MAPS = [
+    'AO'
+]
+
+RECIPE_ICONS = {
+    'NORMAL': 'MATCAP_23',
+    'CURVE': 'MATCAP_10',
+    'DIFFUSE': 'MATCAP_02',
+    'AO': 'MATCAP_09',
+    'POS': 'MATCAP_08',
+    'ID': 'MATCAP_21',
+    'PACK': 'IMAGE_RGB'
+}
+
+MAP_PRECISION = {
+    #Map type: (float buffer in memory, exported bit depth)
+    #Blender images are byte or float, so a map exported at 16 bits needs a float buffer.
+    #Normals stay bytes unless a 16 bit Normal Depth is chosen.
+    'DIFFUSE': (False, 8),
+    'ID': (False, 8),
+    'AO': (True, 16),
+    'CURVE': (True, 16),
+    'NORMAL': (False, 8),
+    'POS': (True, 32),
+    'PACK': (True, 32)
+}
+
 POSSIBLE_GRAYSCALE_MAPS = [
     'AO',
     'CURVE',
@@ -69,12 +202,152 @@ POSSIBLE_GRAYSCALE_MAPS = [
     'POS'
 ]
 
+CHANNEL_ITEMS = [('NONE', 'None', '')] + [(map_type, map_type.title(), '') for map_type in POSSIBLE_GRAYSCALE_MAPS]
+CHANNEL_PACK_PROPS = ['pack_channel_r', 'pack_channel_g', 'pack_channel_b', 'pack_channel_a']
+
+
+##############################
+########### Trace ############
+##############################
+class NullSpan:
+    """Does nothing, handed out by trace() while tracing is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def peak_memory_kb():
+    """Peak resident memory of this process so far"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+class TraceSpan:
+    """Records its duration and peak memory as one complete trace event"""
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.peak = peak_memory_kb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        peak = peak_memory_kb()
+        args = dict(self.args, peak_kb=peak, peak_growth_kb=peak - self.peak)
+        if exc is not None:
+            args['error'] = str(exc)
+        events = TRACE_EVENTS
+        if events is not None:
+            events.append({
+                'name': self.name,
+                'cat': 'bake',
+                'ph': 'X',
+                'ts': (self.start - TRACE_START) * 1e6,
+                'dur': (end - self.start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args
+            })
+        return False
+
+def trace(name, **args):
+    """Context manager timing one stage, a shared no-op while tracing is off"""
+    if TRACE_EVENTS is None:
+        return NULL_SPAN
+    return TraceSpan(name, args)
+
+def traced(func):
+    """Traces every call of func as a stage named after it, for the whole run of a generator"""
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if TRACE_EVENTS is None:
+                return (yield from func(*args, **kwargs))
+            with TraceSpan(func.__name__, {}):
+                return (yield from func(*args, **kwargs))
+        return generator_wrapper
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if TRACE_EVENTS is None:
+            return func(*args, **kwargs)
+        with TraceSpan(func.__name__, {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+def tracing_requested(scn):
+    return scn.trace_bakes or bool(os.environ.get('GB_TRACE'))
+
+def start_trace():
+    global TRACE_EVENTS
+    global TRACE_START
+    TRACE_EVENTS = []
+    TRACE_START = time.perf_counter()
+
+def trace_path(scn):
+    """GB_TRACE names the trace directory, otherwise the export or temp directory is used"""
+    directory = os.environ.get('GB_TRACE', '')
+    if not os.path.isdir(directory):
+        directory = bpy.path.abspath(scn.export_dir) if scn.export_dir else tempfile.gettempdir()
+    name = 'gb_trace_%s_%d.json' % (time.strftime('%Y%m%d_%H%M%S'), os.getpid())
+    return os.path.join(directory, name)
+
+def trace_summary(events):
+    """Table of the stages inside each bake and export, inclusive times"""
+    lines = []
+    events = sorted(events, key=lambda event: event['ts'])
+    times = [event['ts'] for event in events]
+    roots = [event for event in events if event['name'] in ('bake', 'export')]
+    root_ids = set(id(event) for event in roots)
+    for root in roots:
+        start, end = root['ts'], root['ts'] + root['dur']
+        title = ' '.join([root['name']] + [str(value) for key, value in sorted(root['args'].items())
+                                           if key in ('object', 'recipe')])
+        lines.append("%-40s %10.1f ms %8.1f MB" % (title, root['dur'] / 1000.0, root['args']['peak_kb'] / 1024.0))
+        stages = OrderedDict()
+        for event in events[bisect.bisect_left(times, start):bisect.bisect_right(times, end)]:
+            if id(event) in root_ids:
+                continue
+            calls, total, peak = stages.get(event['name'], (0, 0.0, 0))
+            stages[event['name']] = (calls + 1, total + event['dur'], max(peak, event['args']['peak_kb']))
+        for name, (calls, total, peak) in stages.items():
+            lines.append("    %-28s %4dx %10.1f ms %8.1f MB" % (name, calls, total / 1000.0, peak / 1024.0))
+    return '\n'.join(lines)
+
+def stop_trace(filepath):
+    """Writes the trace events for chrome://tracing or Perfetto and prints the summary"""
+    global TRACE_EVENTS
+    events = TRACE_EVENTS
+    TRACE_EVENTS = None
+    if events is None:
+        return None
+    with open(filepath, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    print(trace_summary(events))
+    print("Trace written to %s" % filepath)
+    return filepath
+
 
 ##############################
 ########### Oven #############
 ##############################
+def settings_applied(name, *args):
+    """True if name already applied these settings since the queue started"""
+    if APPLIED_SETTINGS.get(name) == args:
+        return True
+    APPLIED_SETTINGS[name] = args
+    return False
+
 def set_temperature(context, samples, integrator):
     """Sets the appropriate sampling, depending on quality/time desired by user."""
+    if settings_applied('temperature', samples, integrator):
+        return
     cycles = context.scene.cycles
     cycles.progressive = integrator
     cycles.use_square_samples = False
@@ -100,6 +373,8 @@ def set_temperature(context, samples, integrator):
         cycles.volume_samples = 1
 
 def enable_color_bake_settings():
+    if settings_applied('color'):
+        return
     scn = bpy.context.scene
     bake_settings = bpy.data.scenes[scn.name].render.bake
     bake_settings.use_pass_color = True
@@ -107,33 +382,158 @@ def enable_color_bake_settings():
     bake_settings.use_pass_indirect = False
 
 def enable_normal_bake_settings(engine):
+    if settings_applied('normal', engine):
+        return
     scn = bpy.context.scene
     bake_settings = bpy.data.scenes[scn.name].render.bake
 
-    if engine == 'UNITY':
-        bake_settings.normal_r = 'POS_X'
-        bake_settings.normal_g = 'POS_Y'
-        bake_settings.normal_b = 'POS_Z'
-    elif engine == 'UNREAL':
-        bake_settings.normal_r = 'POS_X'
-        bake_settings.normal_g = 'NEG_Y'
-        bake_settings.normal_b = 'POS_Z'
+    if engine in ENGINE_SWIZZLES:
+        swizzle = ENGINE_SWIZZLES[engine]
+        bake_settings.normal_r = swizzle[0]
+        bake_settings.normal_g = swizzle[1]
+        bake_settings.normal_b = swizzle[2]
 
 def bake(context, recipe, bake_image):
+    if needs_tiling(context, bake_image):
+        yield from bake_tiled(context, recipe, bake_image)
+    else:
+        yield from bake_recipe(context, recipe, bake_image)
+    return bake_image
+
+@traced
+def bake_recipe(context, recipe, bake_image):
     if recipe == 'NORMAL':
-        bake_normal(context, bake_image)
+        yield from bake_normal(context, bake_image)
     elif recipe == 'DIFFUSE':
-        bake_diffuse(context, bake_image)
+        yield from bake_diffuse(context, bake_image)
     elif recipe == 'AO':
-        bake_ao(context, bake_image)
+        yield from bake_ao(context, bake_image)
     elif recipe == 'CURVE':
-        bake_curvature(context, bake_image)
+        yield from bake_curvature(context, bake_image)
     elif recipe == 'POS':
-        bake_position(context, bake_image)
+        yield from bake_position(context, bake_image)
     elif recipe == 'ID':
-        bake_id(context, bake_image)
+        yield from bake_id(context, bake_image)
+    elif recipe == 'PACK':
+        yield from bake_packed(context, bake_image)
     return bake_image
 
+def needs_tiling(context, img):
+    scn = context.scene
+    budget = scn.bake_memory_budget * 1024 * 1024
+    return scn.use_tiled_bake and img.size[0] * img.size[1] * TILE_BYTES_PER_PIXEL > budget
+
+def tile_size(width, height, budget_mb):
+    """Returns the largest power of two tile that bakes within the memory budget"""
+    budget = budget_mb * 1024 * 1024
+    size = 64
+    while size < max(width, height) and (size * 2) ** 2 * TILE_BYTES_PER_PIXEL <= budget:
+        size *= 2
+    return size
+
+def swap_active_image(ob, img):
+    """Points the active image node of each material on ob at img, returns the previous images"""
+    previous = []
+    for slot in ob.material_slots:
+        node = slot.material.node_tree.nodes.active
+        previous.append(node.image)
+        node.image = img
+    return previous
+
+def restore_active_image(ob, previous):
+    for slot, img in zip(ob.material_slots, previous):
+        slot.material.node_tree.nodes.active.image = img
+
+@traced
+def bake_tiled(context, recipe, img):
+    """Bakes img one UV region at a time into a memory mapped scratch file.
+
+    Each tile is baked through a temporary UV layer that maps the region (padded
+    by the bake margin) onto a small image, so Cycles only ever allocates tile
+    sized buffers. The tiles are stitched into img at the end."""
+    scn = context.scene
+    ob = bpy.data.objects[scn.low_poly]
+    me = ob.data
+    width, height = img.size
+    tile = tile_size(width, height, scn.bake_memory_budget)
+    margin = scn.render.bake.margin
+
+    source = me.uv_layers.active
+    uv = np.empty(len(source.data) * 2, dtype=np.float32)
+    source.data.foreach_get('uv', uv)
+    uv = uv.reshape(-1, 2) * (width, height)
+    active_index = me.uv_textures.active_index
+    me.uv_textures.new('gb_tile')
+    tile_index = len(me.uv_textures) - 1
+    tile_layer = me.uv_layers[tile_index]
+    me.uv_textures.active_index = tile_index
+
+    scratch_file = tempfile.NamedTemporaryFile(prefix='gb_tiles_', suffix='.raw', delete=False)
+    scratch_file.close()
+    scratch = np.memmap(scratch_file.name, dtype=np.float32, mode='w+', shape=(height, width, 4))
+    tile_img = None
+    try:
+        for y0 in range(0, height, tile):
+            for x0 in range(0, width, tile):
+                x1 = min(x0 + tile, width)
+                y1 = min(y0 + tile, height)
+                px0, py0 = max(0, x0 - margin), max(0, y0 - margin)
+                px1, py1 = min(width, x1 + margin), min(height, y1 + margin)
+                size = (px1 - px0, py1 - py0)
+                #A fresh image per tile, an asynchronous bake is done once it turns dirty
+                tile_img = bpy.data.images.new('gb_tile', size[0], size[1], float_buffer=True)
+
+                tile_uv = (uv - (px0, py0)) / size
+                tile_layer.data.foreach_set('uv', tile_uv.astype(np.float32).ravel())
+                previous = swap_active_image(ob, tile_img)
+                try:
+                    yield from bake_recipe(context, recipe, tile_img)
+                finally:
+                    restore_active_image(ob, previous)
+
+                pixels = image_buffer(tile_img)
+                scratch[y0:y1, x0:x1] = pixels[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+                scratch.flush()
+                bpy.data.images.remove(tile_img, do_unlink=True)
+                tile_img = None
+        load_tiles(img, scratch)
+    finally:
+        me.uv_textures.active_index = active_index
+        me.uv_textures.remove(me.uv_textures[tile_index])
+        if tile_img is not None:
+            bpy.data.images.remove(tile_img, do_unlink=True)
+        del scratch
+        os.remove(scratch_file.name)
+
+def load_tiles(img, scratch):
+    """Moves the stitched scratch buffer into img through a file Blender reads, then packs it.
+
+    Setting pixels from Python would copy the whole image into a Python sequence
+    first; a float EXR or byte TGA is written a band of rows at a time instead."""
+    height, width = scratch.shape[:2]
+    handle, filepath = tempfile.mkstemp(prefix='gb_tiles_', suffix='.exr' if img.is_float else '.tga')
+    os.close(handle)
+    colorspace = img.colorspace_settings.name
+    try:
+        if img.is_float:
+            write_exr(filepath, scratch, half=False)
+        else:
+            with open(filepath, 'wb') as f:
+                f.write(struct.pack('<BBBHHBHHHHBB', 0, 0, 2, 0, 0, 0, 0, 0, width, height, 32, 8))
+                for y0 in range(0, height, TILE_ROWS):
+                    rows = np.array(scratch[y0:y0 + TILE_ROWS])
+                    if colorspace not in {'Non-Color', 'Raw'}:
+                        #The tiles are float, a byte colour image holds sRGB like a direct bake
+                        rows[..., :3] = linear_to_srgb(rows[..., :3])
+                    f.write(quantize(rows, 8)[..., [2, 1, 0, 3]].tobytes()) #BGRA, bottom row first
+        img.source = 'FILE'
+        img.filepath_raw = filepath
+        img.reload()
+        img.pack()
+        img.colorspace_settings.name = colorspace
+    finally:
+        os.remove(filepath)
+
 def register_bake_settings():
     """Registers bake settings"""
     scn = bpy.types.Scene
@@ -149,12 +549,62 @@ def register_bake_settings():
         items=[('UNITY', 'Unity (+Y)', ''),
                 ('UNREAL', 'Unreal (-Y)', '')],
         name="Engine")
+    scn.normal_variants = EnumProperty(
+        items=[('UNITY', 'Unity', ''),
+               ('UNREAL', 'Unreal', ''),
+               ('CUSTOM', 'Custom', '')],
+        name="Also",
+        options={'ENUM_FLAG'},
+        description="Extra normal maps derived from the same bake")
+    scn.normal_swizzle_r = EnumProperty(items=SWIZZLE_ITEMS, name="R", default='POS_X')
+    scn.normal_swizzle_g = EnumProperty(items=SWIZZLE_ITEMS, name="G", default='POS_Y')
+    scn.normal_swizzle_b = EnumProperty(items=SWIZZLE_ITEMS, name="B", default='POS_Z')
+    scn.normal_to_tangent = BoolProperty(
+        name="Derive Tangent",
+        default=False,
+        description="Also derive a tangent space map from the object space bake")
+    scn.normal_depth = EnumProperty(
+        items=[('8', '8 bit', 'Byte buffer, exported at 8 bits'),
+               ('16', '16 bit', 'Float buffer (4x the memory), exported at 16 bits where the format allows')],
+        name="Depth",
+        default='8')
     scn.ao_quality = EnumProperty(
         items=[('LOW', 'Low', ''),
                 ('MID', 'Mid', ''),
                 ('HIGH', 'High', ''),
                 ('VHIGH', 'Very High', '')],
         name="Quality")
+    scn.ao_adaptive = BoolProperty(
+        name="Adaptive",
+        default=False,
+        description="Bake in rounds of increasing samples until the noise target or time budget is met, "
+                    "never above the quality's sample count")
+    scn.ao_noise_target = FloatProperty(
+        name="Noise",
+        default=0.01,
+        min=0.0,
+        precision=4,
+        description="Stop once the estimated standard deviation of the result is below this")
+    scn.ao_time_budget = FloatProperty(
+        name="Seconds",
+        default=0.0,
+        min=0.0,
+        description="Stop before a round would exceed this many seconds (0 for no limit)")
+    scn.denoise_bakes = BoolProperty(
+        name="Denoise",
+        default=False,
+        description="Smooth sampling noise with an edge aware filter after baking")
+    scn.denoise_radius = IntProperty(
+        name="Radius",
+        default=2,
+        min=1,
+        max=8,
+        subtype='PIXEL')
+    scn.denoise_sigma = FloatProperty(
+        name="Sigma",
+        default=0.1,
+        min=0.001,
+        description="Value difference still treated as noise; lower keeps more detail")
     scn.dif_quality = EnumProperty(
         items=[('LOW', 'Low', ''),
                 ('MID', 'Mid', ''),
@@ -181,15 +631,69 @@ def register_bake_settings():
         default=False,
         name='Z'
     )
+    scn.curvature_engine = EnumProperty(
+        items=ENGINE_ITEMS,
+        name="Engine")
+    scn.position_engine = EnumProperty(
+        items=ENGINE_ITEMS,
+        name="Engine")
+    scn.id_engine = EnumProperty(
+        items=ENGINE_ITEMS,
+        name="Engine")
+    scn.pack_grayscale = BoolProperty(
+        name="Pack Grayscale",
+        default=False,
+        description="Bake curvature, position and ID into the R, G and B channels in one pass"
+    )
+    scn.pack_output = EnumProperty(
+        items=[('PACKED', 'Packed', 'Keep the RGB packed texture'),
+               ('SPLIT', 'Split', 'Split the channels into the individual maps')],
+        name="Output")
     scn.cage_distance = FloatProperty(
         name="Distance",
         default=2,
+        update=update_cage_distance
     )
+    scn.cage_mode = EnumProperty(
+        items=[('GLOBAL', 'Global', 'Set one distance just large enough for every vertex'),
+               ('VARYING', 'Varying', 'Build a cage pushed out by what each vertex needs')],
+        name="Cage")
+    scn.cage_margin = FloatProperty(
+        name="Margin",
+        default=0.1,
+        min=0.0,
+        subtype='FACTOR',
+        description="Extra distance on top of the measured one, relative to it")
+    scn.batch_pairing = EnumProperty(
+        items=[('NAME', 'Names', 'Pair meshes whose names only differ by the suffixes'),
+               ('GROUP', 'Groups', 'Pair the lowpoly and highpoly mesh of every group')],
+        name="Pairing")
+    scn.batch_low_suffix = StringProperty(
+        name="Low",
+        default="_low")
+    scn.batch_high_suffix = StringProperty(
+        name="High",
+        default="_high")
     scn.overwrite_bakes = BoolProperty(
         name="Overwrite Bakes",
         default=False,
         description="Overwrite the existing image with the new bake."
     )
+    scn.skip_unchanged = BoolProperty(
+        name="Skip Unchanged",
+        default=True,
+        description="Don't rebake maps whose meshes and settings haven't changed"
+    )
+    scn.trace_bakes = BoolProperty(
+        name="Trace",
+        default=False,
+        description="Time every bake and export stage and write a Chrome trace (also enabled by GB_TRACE)"
+    )
+    scn.stream_bakes = BoolProperty(
+        name="Stream to Disk",
+        default=False,
+        description="Export every map as soon as it is baked and keep only a small proxy of it in memory"
+    )
     scn.export_dir = StringProperty(
         default="",
         subtype='FILE_PATH'
@@ -199,10 +703,35 @@ def unregister_bake_settings():
     scn = bpy.types.Scene
     del scn.bake_map
     del scn.engine_type
+    del scn.normal_variants
+    del scn.normal_swizzle_r
+    del scn.normal_swizzle_g
+    del scn.normal_swizzle_b
+    del scn.normal_to_tangent
+    del scn.normal_depth
     del scn.ao_quality
     del scn.dif_quality
+    del scn.ao_adaptive
+    del scn.ao_noise_target
+    del scn.ao_time_budget
+    del scn.denoise_bakes
+    del scn.denoise_radius
+    del scn.denoise_sigma
     del scn.cage_distance
+    del scn.cage_mode
+    del scn.cage_margin
+    del scn.batch_pairing
+    del scn.batch_low_suffix
+    del scn.batch_high_suffix
+    del scn.curvature_engine
+    del scn.position_engine
+    del scn.pack_grayscale
+    del scn.pack_output
+    del scn.id_engine
     del scn.overwrite_bakes
+    del scn.skip_unchanged
+    del scn.trace_bakes
+    del scn.stream_bakes
     del scn.export_dir
     del scn.bake_id_type
     del scn.bake_id_color
@@ -216,23 +745,89 @@ def unregister_bake_settings():
 ##############################
 def get_img(name, width, height, floatbuffer, img_id=False, replace_id=None):
     """Returns an image type, optionally with an ID"""
+    image_index()
     img = bpy.data.images.new(name, width, height, float_buffer=floatbuffer)
     img.use_fake_user = True
     if img_id:
         img['bake_id'] = name
     elif replace_id is not None:
         img['bake_id'] = replace_id
+    track_new_img(img)
     return img
 
-def replace_img(img, width, height, bake_id):
+def replace_img(img, width, height, bake_id, floatbuffer=True):
     """Replaces given image with a new one given the parameters"""
     scn = bpy.context.scene
     name = img.name
-    if width == img.size[0] and height == img.size[1]:
+    #Tiled bakes leave a packed file image, baking into it again wouldn't be saved.
+    #A dirty image can't tell the scheduler when an asynchronous bake into it is done.
+    if (width == img.size[0] and height == img.size[1] and img.is_float == floatbuffer
+            and img.source == 'GENERATED' and not img.is_dirty):
         return img
     else:
-        bpy.data.images.remove(img, do_unlink=True)
-        return get_img(name, width, height, floatbuffer=True, replace_id=bake_id)
+        remove_img(img)
+        return get_img(name, width, height, floatbuffer=floatbuffer, replace_id=bake_id)
+
+def image_index():
+    """Returns the bake_id -> image name index, rebuilt when bpy.data.images changed"""
+    global BAKE_IMAGES_COUNT
+    if BAKE_IMAGES_COUNT != len(bpy.data.images):
+        BAKE_IMAGES.clear()
+        for image in bpy.data.images:
+            bake_id = image.get('bake_id')
+            if bake_id:
+                BAKE_IMAGES[bake_id] = image.name
+        BAKE_IMAGES_COUNT = len(bpy.data.images)
+    return BAKE_IMAGES
+
+def invalidate_image_index():
+    global BAKE_IMAGES_COUNT
+    BAKE_IMAGES_COUNT = None
+
+def track_new_img(img):
+    """Adds an image created after image_index() to the index without a rescan"""
+    global BAKE_IMAGES_COUNT
+    BAKE_IMAGES_COUNT += 1
+    bake_id = img.get('bake_id')
+    if bake_id:
+        BAKE_IMAGES[bake_id] = img.name
+
+def untrack_img(img):
+    """Removes the bake_id from img so it's no longer seen as a bake"""
+    bake_id = img.get('bake_id')
+    if bake_id is not None:
+        del img['bake_id']
+        if BAKE_IMAGES.get(bake_id) == img.name:
+            del BAKE_IMAGES[bake_id]
+
+def remove_img(img):
+    global BAKE_IMAGES_COUNT
+    image_index()
+    untrack_img(img)
+    bpy.data.images.remove(img, do_unlink=True)
+    BAKE_IMAGES_COUNT -= 1
+
+def find_bake_image(bake_id):
+    """Returns the image tagged with bake_id, or None"""
+    name = image_index().get(bake_id)
+    if name is None:
+        return None
+    image = bpy.data.images.get(name)
+    if image is None or image.get('bake_id') != bake_id:
+        #Renamed or retagged behind our back
+        invalidate_image_index()
+        name = image_index().get(bake_id)
+        image = bpy.data.images.get(name) if name is not None else None
+    return image
+
+def bake_images():
+    """Returns every image tagged with a bake_id"""
+    images = []
+    for bake_id in list(image_index()):
+        image = find_bake_image(bake_id)
+        if image is not None:
+            images.append(image)
+    return images
 
 def get_mat(name):
     """Returns a material with appropriate naming and enables nodes"""
@@ -240,7 +835,96 @@ def get_mat(name):
     mat.use_nodes = True
     return mat
 
-#def set_image_quality()
+def add_bake_image_node(nodes):
+    """Adds the image node a bake material renders into"""
+    img_node = nodes.new("ShaderNodeTexImage")
+    img_node.name = 'gb_bake_image'
+    return img_node
+
+@traced
+def get_bake_mat(key, build):
+    """Returns the cached bake material for key, building it with build(mat) on a miss"""
+    name = BAKE_MATERIALS.get(key)
+    mat = bpy.data.materials.get(name) if name is not None else None
+    BAKE_MATERIALS_IN_USE.add(key)
+    if mat is not None and mat.get('bake_cache') == str(key):
+        BAKE_MATERIALS.move_to_end(key)
+        return mat
+    mat = get_mat('_'.join(['GB', str(key[0]), 'MAT']))
+    mat['bake_cache'] = str(key)
+    build(mat)
+    BAKE_MATERIALS[key] = mat.name
+    trim_bake_materials()
+    return mat
+
+def trim_bake_materials():
+    """Evicts the least recently used bake materials over the limit, except the ones in use"""
+    for key in [key for key in BAKE_MATERIALS if key not in BAKE_MATERIALS_IN_USE]:
+        if len(BAKE_MATERIALS) <= BAKE_MATERIAL_LIMIT:
+            break
+        remove_cached_mat(BAKE_MATERIALS.pop(key))
+
+def retarget_bake_mat(mat, img):
+    """Points the image node of a cached bake material at img"""
+    img_node = mat.node_tree.nodes['gb_bake_image']
+    img_node.image = img
+    mat.node_tree.nodes.active = img_node
+
+def remove_cached_mat(name):
+    mat = bpy.data.materials.get(name)
+    if mat is not None and 'bake_cache' in mat:
+        bpy.data.materials.remove(mat, do_unlink=True)
+
+def clear_bake_materials():
+    """Removes every cached bake material"""
+    for name in BAKE_MATERIALS.values():
+        remove_cached_mat(name)
+    BAKE_MATERIALS.clear()
+    BAKE_MATERIALS_IN_USE.clear()
+
+def get_map_name(ob, map_type):   #Check if ob['name'] is set anywhere?
+    try:
+        if ob['name']:
+            ob_name = ob['name']
+    except:
+        ob_name = ob.name
+    return ''.join([ob_name, '_', map_type])
+
+@traced
+def make_image_with_id(context, map_name, width, height, map_type):
+    """Returns the image tagged with map_name, replacing or retiring an existing one.
+    Its buffer type follows the precision of map_type."""
+    floatbuffer = map_precision(map_type)[0]
+    image = find_bake_image(map_name)
+    if image is None:
+        bake_image = get_img(map_name, width, height, floatbuffer=floatbuffer, img_id=True)
+    elif context.scene.overwrite_bakes:
+        bake_image = replace_img(image, width, height, map_name, floatbuffer)
+    else:
+        untrack_img(image)
+        bake_image = get_img(map_name, width, height, floatbuffer=floatbuffer, img_id=True)
+    for key in ('bake_file', 'bake_size'):
+        if key in bake_image:
+            del bake_image[key]
+    if map_type.startswith('NORMAL'):
+        #Normals are vectors, never colour managed in memory or on export. A float
+        #image defaults to Linear, which the exporters would encode with the sRGB curve.
+        bake_image.colorspace_settings.name = 'Non-Color'
+    elif is_non_color(context, map_type):
+        #Data maps, float or byte, are never colour managed in memory or on export
+        bake_image.colorspace_settings.name = 'Non-Color'
+    elif not bake_image.is_float:
+        bake_image.colorspace_settings.name = 'sRGB'
+    #bake_image.pack(as_png=True) #Compresses the results. Packing should be done by the user
+    return bake_image
+
+def map_precision(map_type):
+    """(float buffer, export bit depth) of map_type, normal variants follow NORMAL"""
+    if map_type not in MAP_PRECISION and map_type.startswith('NORMAL'):
+        map_type = 'NORMAL'
+    if map_type == 'NORMAL' and bpy.context.scene.normal_depth == '16':
+        return (True, 16)
+    return MAP_PRECISION.get(map_type, (True, 16))
 
 def register_ingredients():
     """Registers settings for ingredients"""
@@ -257,17 +941,49 @@ def register_ingredients():
         min=1,
         subtype='PIXEL'
     )
+    scn.use_tiled_bake = BoolProperty(
+        name="Tiled",
+        default=False,
+        description="Bake large images in tiles to stay within the memory budget"
+    )
+    scn.bake_memory_budget = IntProperty(
+        name="Budget (MB)",
+        default=2048,
+        min=64,
+        description="Memory a single bake tile may use"
+    )
     scn.image_format = EnumProperty(
-        items=[('PNG', 'PNG', ''),
-               ('TARGA', 'TGA', ''),
-               ('TARGA_RAW', 'TGA(RAW)', ''),
-               ('BMP', 'BMP', ''),
-               ('TIFF', 'TIFF', ''),
-               ('JPEG', 'JPG', ''),
-               ('DPX', 'DPX', ''),
-               ('OPEN_EXR', 'OpenEXR', '')],
+        items=IMAGE_FORMATS,
         name='Format'
     )
+    scn.extra_image_formats = EnumProperty(
+        items=IMAGE_FORMATS,
+        name='Also',
+        options={'ENUM_FLAG'},
+        description="Additional formats written from the same pixels"
+    )
+    scn.export_mips = BoolProperty(
+        name="Mipmaps",
+        default=False,
+        description="Also write every mip level as a _mipN file (DDS files always hold their mipmaps)"
+    )
+    scn.mip_filter = EnumProperty(
+        items=[('BOX', 'Box', 'Average 2x2 texels, fast and soft'),
+               ('KAISER', 'Kaiser', 'Kaiser windowed sinc, keeps detail sharper in the smaller levels')],
+        name="Mip Filter",
+        description="Downsampling filter of the mip levels, which only average texels inside the UV islands"
+    )
+    scn.export_channel_pack = BoolProperty(
+        name="Channel Pack",
+        default=False,
+        description="Export the chosen grayscale maps of each object as the channels of one <object>_CHANNELS file"
+    )
+    for prop, channel, default in zip(CHANNEL_PACK_PROPS, 'RGBA', ['AO', 'CURVE', 'NONE', 'NONE']):
+        setattr(scn, prop, EnumProperty(
+            items=CHANNEL_ITEMS,
+            name=channel,
+            default=default,
+            description="Map exported in the %s channel" % channel))
     scn.high_poly = StringProperty(
         name="HP",
         default=''
@@ -282,7 +998,15 @@ def unregister_ingredients():
     scn = bpy.types.Scene
     del scn.bake_width
     del scn.bake_height
+    del scn.use_tiled_bake
+    del scn.bake_memory_budget
     del scn.image_format
+    del scn.extra_image_formats
+    del scn.export_channel_pack
+    del scn.export_mips
+    del scn.mip_filter
+    for prop in CHANNEL_PACK_PROPS:
+        delattr(scn, prop)
     del scn.high_poly
     del scn.low_poly
 
@@ -290,39 +1014,190 @@ def unregister_ingredients():
 ##############################
 ########## Recipes ###########
 ##############################
+@traced
+def run_bake(bake_type, img):
+    """One Cycles pass of a bake into img. Bakes are generators yielding their passes
+    as (bake type, image); run_blocking bakes them in place, the scheduler starts
+    them asynchronously and resumes the bake once img has been written."""
+    yield (bake_type, img)
+
+def run_blocking(steps):
+    """Drives a bake generator, running each Cycles pass to completion, returns its result"""
+    try:
+        bake_type, img = next(steps)
+        while True:
+            bpy.ops.object.bake(type=bake_type)
+            bake_type, img = next(steps)
+    except StopIteration as stop:
+        return stop.value
+
 def bake_ao(context, img):
+    if context.scene.ao_adaptive:
+        return (yield from bake_ao_adaptive(context, img))
     samples = AO_QUALITY_SAMPLES[context.scene.ao_quality]
     set_temperature(context, samples, 'BRANCHED_PATH')
-    if len(BAKELIST) > 1:
-        bpy.ops.object.bake(type='AO')
-    else:
-        LASTIMG = 'AO'
-        bpy.ops.object.bake('INVOKE_DEFAULT', type='AO')
-        BAKEIMG = img
+    yield from run_bake('AO', img)
+
+@traced
+def bake_ao_adaptive(context, img):
+    """Bakes AO in rounds of doubling sample counts, averaging them into img.
+
+    After every round the noise of the running average is estimated from how
+    much the new round differs from it. Baking stops at the noise target, when
+    the next round would overrun the time budget, or at the quality's samples."""
+    scn = context.scene
+    ob = bpy.data.objects[scn.low_poly]
+    width, height = img.size
+    max_samples = AO_QUALITY_SAMPLES[scn.ao_quality]
+    mask = coverage_mask(context, ob, width, height)
+    round_img = None
+    previous = swap_active_image(ob, None)
+    seed = scn.cycles.seed
+    start = time.time()
+    samples = min(AO_FIRST_ROUND_SAMPLES, max_samples)
+    total = 0
+    rounds = 0
+    noise = -1.0
+    mean = None
+    try:
+        while True:
+            round_start = time.time()
+            #A fresh image per round, an asynchronous bake is done once it turns dirty
+            round_img = bpy.data.images.new('gb_ao_round', width, height, float_buffer=True)
+            swap_active_image(ob, round_img)
+            set_temperature(context, samples, 'BRANCHED_PATH')
+            scn.cycles.seed = seed + rounds
+            yield from run_bake('AO', round_img)
+            buf = image_buffer(round_img)
+            bpy.data.images.remove(round_img, do_unlink=True)
+            round_img = None
+            if mean is None:
+                mean = buf.copy()
+            else:
+                difference = buf[mask, 0] - mean[mask, 0]
+                #Var(difference) = var/samples + var/total for a per sample variance var
+                variance = (difference ** 2).mean() / (1.0 / samples + 1.0 / total) if difference.size else 0.0
+                mean += (buf - mean) * (samples / float(total + samples))
+                noise = float(np.sqrt(variance / (total + samples)))
+            total += samples
+            rounds += 1
+            round_time = time.time() - round_start
+            next_samples = min(samples * 2, max_samples - total)
+            if 0 <= noise <= scn.ao_noise_target or next_samples <= 0:
+                break
+            if scn.ao_time_budget > 0:
+                estimate = round_time * next_samples / float(samples)
+                if time.time() - start + estimate > scn.ao_time_budget:
+                    break
+            samples = next_samples
+        write_pixels(img, mean)
+    finally:
+        scn.cycles.seed = seed
+        restore_active_image(ob, previous)
+        if round_img is not None:
+            bpy.data.images.remove(round_img, do_unlink=True)
+    img['ao_rounds'] = rounds
+    img['ao_samples'] = total
+    img['ao_noise'] = noise
+    print("AO: %d rounds, %d samples, noise %.4f, %.1fs" % (rounds, total, noise, time.time() - start))
 
 def bake_diffuse(context, img):
     samples = DIF_QUALITY_SAMPLES[context.scene.dif_quality] #Will be used for direct/indirect lighting
     cbk = context.scene.render.bake
     set_temperature(context, 1, 'PATH')
-    if len(BAKELIST) > 1:
-        bpy.ops.object.bake(type='DIFFUSE')
-    else:
-        LASTIMG = 'DIFFUSE'
-        bpy.ops.object.bake('INVOKE_DEFAULT', type='DIFFUSE')
-        BAKEIMG = img
+    yield from run_bake('DIFFUSE', img)
 
 def bake_normal(context, img):
     context.scene.cycles.bake_type = 'NORMAL'
     engine_type = context.scene.engine_type
     enable_normal_bake_settings(engine_type)
     set_temperature(context, 1, 'PATH')
-    if len(BAKELIST) > 1:
-        bpy.ops.object.bake(type='NORMAL')
-    else:
-        LASTIMG = 'NORMAL'
-        bpy.ops.object.bake('INVOKE_DEFAULT', type='NORMAL')
-        BAKEIMG = img
+    yield from run_bake('NORMAL', img)
+
+def normal_outputs(scn):
+    """The baked normal map followed by the variants derived from it"""
+    outputs = ['NORMAL']
+    for variant in sorted(scn.normal_variants):
+        if variant != scn.engine_type:
+            outputs.append('_'.join(['NORMAL', variant]))
+    if scn.normal_to_tangent and scn.render.bake.normal_space == 'OBJECT':
+        outputs.append('NORMAL_TANGENT')
+    return outputs
+
+def normal_swizzle(scn, variant):
+    if variant == 'CUSTOM':
+        return (scn.normal_swizzle_r, scn.normal_swizzle_g, scn.normal_swizzle_b)
+    return ENGINE_SWIZZLES[variant]
+
+def decode_normals(rgb, swizzle):
+    """Turns encoded normal map colours into vectors, given the swizzle they were baked with"""
+    vectors = np.empty(rgb.shape, dtype=np.float32)
+    for channel, axis in enumerate(swizzle):
+        sign = -1.0 if axis.startswith('NEG') else 1.0
+        vectors[..., 'XYZ'.index(axis[-1])] = sign * (rgb[..., channel] * 2.0 - 1.0)
+    return vectors
 
+def encode_normals(vectors, swizzle):
+    rgb = np.empty(vectors.shape, dtype=np.float32)
+    for channel, axis in enumerate(swizzle):
+        sign = -1.0 if axis.startswith('NEG') else 1.0
+        rgb[..., channel] = sign * vectors[..., 'XYZ'.index(axis[-1])] * 0.5 + 0.5
+    return rgb
+
+def object_to_tangent(context, ob, buf, vectors, swizzle):
+    """Re-expresses an object space normal bake in the tangent space of ob's UV layout.
+
+    Tangents are taken per triangle from the UV gradients and orthogonalized
+    against the interpolated normal, which is close to but not exactly MikkTSpace."""
+    height, width = buf.shape[:2]
+    lp = mesh_arrays(ob, context.scene)
+    pixels, tri, bary = lp_texels(lp, width, height)
+    corners = lp['local_co'][lp['loop_verts'][lp['tris']]]
+    uvs = lp['uv'][lp['tris']]
+    e1, e2 = corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    d1, d2 = uvs[:, 1] - uvs[:, 0], uvs[:, 2] - uvs[:, 0]
+    r = d1[:, 0] * d2[:, 1] - d2[:, 0] * d1[:, 1]
+    r[r == 0] = 1e-12
+    tangents = (e1 * d2[:, 1:2] - e2 * d1[:, 1:2]) / r[:, None]
+    bitangents = (e2 * d1[:, 0:1] - e1 * d2[:, 0:1]) / r[:, None]
+
+    normal = interpolate(lp['local_loop_normals'][lp['tris']], tri, bary)
+    normal /= np.maximum(np.linalg.norm(normal, axis=1), 1e-12)[:, None]
+    tangent = tangents[tri] - normal * (tangents[tri] * normal).sum(1)[:, None]
+    tangent /= np.maximum(np.linalg.norm(tangent, axis=1), 1e-12)[:, None]
+    bitangent = np.cross(normal, tangent)
+    bitangent *= np.where((bitangent * bitangents[tri]).sum(1) < 0, -1.0, 1.0)[:, None]
+
+    vector = vectors.reshape(-1, 3)[pixels]
+    local = np.stack([(vector * tangent).sum(1), (vector * bitangent).sum(1), (vector * normal).sum(1)], axis=1)
+    out = buf.copy().reshape(-1, 4)
+    out[pixels, :3] = encode_normals(local, swizzle)
+    mask = np.zeros(width * height, dtype=bool)
+    mask[pixels] = True
+    return dilate(out.reshape(height, width, 4), mask.reshape(height, width), context.scene.render.bake.margin)
+
+@traced
+def normal_variants(context, ob, img, variants):
+    """Derives the requested normal map variants from the pixels of a finished normal bake"""
+    scn = context.scene
+    cbk = scn.render.bake
+    width, height = img.size
+    buf = image_buffer(img)
+    vectors = decode_normals(buf[..., :3], (cbk.normal_r, cbk.normal_g, cbk.normal_b))
+    images = []
+    for variant in variants:
+        name = variant.split('_', 1)[1]
+        if name == 'TANGENT':
+            out = object_to_tangent(context, ob, buf, vectors, ENGINE_SWIZZLES[scn.engine_type])
+        else:
+            out = buf.copy()
+            out[..., :3] = encode_normals(vectors, normal_swizzle(scn, name))
+        variant_image = make_image_with_id(context, get_map_name(ob, variant), width, height, variant)
+        write_pixels(variant_image, out)
+        images.append(variant_image)
+    return images
+
+@traced
 def apply_bake_material(ob, bake_mat=None, bake_mat_list=None):
     """Replaces materials and returns a list with the original"""
     original_mats = []
@@ -336,13 +1211,18 @@ def apply_bake_material(ob, bake_mat=None, bake_mat_list=None):
             mat.material = bake_mat_list[idx]
     return original_mats
 
+@traced
 def remove_bake_material(ob, original_mats):
     """Removes bake material and applies the given list of materials"""
     for idx, mat in enumerate(ob.material_slots):
         mat.material = original_mats[idx]
+    BAKE_MATERIALS_IN_USE.clear()
+    trim_bake_materials()
 
 def bake_curvature(context, img):
     """Method for baking curvature map"""
+    if context.scene.curvature_engine == 'GEOMETRY':
+        return bake_curvature_geometry(context, img)
     set_temperature(context, 1, 'PATH')
     enable_color_bake_settings()
     high_to_low = context.scene.render.bake.use_selected_to_active
@@ -352,125 +1232,104 @@ def bake_curvature(context, img):
         ob = bpy.data.objects[context.scene.low_poly]
 
     #MATERIAL CONSTRUCTION#
-    curve_mat = bpy.data.materials.new("tmp_curve_mat")
-    curve_mat.use_nodes = True
-    nodes = curve_mat.node_tree.nodes
-    links = curve_mat.node_tree.links
-    out_node = nodes[1]
-    geo_node = nodes.new("ShaderNodeNewGeometry")
-    img_node = nodes.new("ShaderNodeTexImage")
-    img_node.color_space = 'NONE'
-    links.new(geo_node.outputs[7], out_node.inputs[0])
-    img_node.image = img
-    nodes.active = img_node
-    
+    def build(curve_mat):
+        nodes = curve_mat.node_tree.nodes
+        links = curve_mat.node_tree.links
+        out_node = nodes[1]
+        geo_node = nodes.new("ShaderNodeNewGeometry")
+        img_node = add_bake_image_node(nodes)
+        img_node.color_space = 'NONE'
+        links.new(geo_node.outputs[7], out_node.inputs[0])
+    curve_mat = get_bake_mat(('CURVE',), build)
+    retarget_bake_mat(curve_mat, img)
+
     #APPLICATION; BAKE; REMOVAL#
     original_mats = apply_bake_material(ob, curve_mat)
-    bpy.ops.object.bake(type='DIFFUSE')
+    yield from run_bake('DIFFUSE', img)
     remove_bake_material(ob, original_mats)
 
-    #MATERIAL DESTRUCTION#
-    bpy.data.materials.remove(curve_mat, do_unlink=True)
+POSITION_CHANNELS = [
+    ('R', 'x', None),   #Left-to-right
+    ('G', 'z', 1),      #Bottom-to-top
+    ('B', 'y', 2)       #Back-to-front
+]
+
+def add_position_gradients(nodes, links, channels):
+    """Adds an object space gradient per channel in channels and returns their outputs"""
+    tex_coord_node = nodes.new("ShaderNodeTexCoord")
+    gradients = OrderedDict()
+    for channel, axis, rotation in POSITION_CHANNELS:
+        if channel not in channels:
+            continue
+        mapping_node = nodes.new("ShaderNodeMapping")
+        mapping_node.name = '_'.join(['gb_mapping', channel])
+        if rotation is not None:
+            mapping_node.rotation[rotation] = 1.5708 #Radian rotation of 90 degrees
+        gradient_node = nodes.new("ShaderNodeTexGradient")
+        links.new(tex_coord_node.outputs[3], mapping_node.inputs[0])
+        links.new(mapping_node.outputs[0], gradient_node.inputs[0])
+        gradients[channel] = gradient_node.outputs[0]
+    return gradients
+
+def update_position_mapping(mat, ob):
+    """Fits the position gradients of a (cached) material to the extents of ob"""
+    nodes = mat.node_tree.nodes
+    for channel, axis, rotation in POSITION_CHANNELS:
+        mapping_node = nodes.get('_'.join(['gb_mapping', channel]))
+        if mapping_node is None:
+            continue
+        idx = 'xyz'.index(axis)
+        min_vertex_position = abs(min_vertex(ob.data, axis))
+        true_scale = 1/ob.dimensions[idx]
+        mapping_node.scale[idx] = true_scale
+        mapping_node.translation[0] = min_vertex_position * true_scale
 
 def bake_position(context, img):
     """Method for baking position map"""
+    if context.scene.position_engine == 'GEOMETRY':
+        return bake_position_geometry(context, img)
     set_temperature(context, 1, 'PATH')
     enable_color_bake_settings()
     high_to_low = context.scene.render.bake.use_selected_to_active
-    x_axis = context.scene.bake_pos_x
-    y_axis = context.scene.bake_pos_y
-    z_axis = context.scene.bake_pos_z
+    axes = [context.scene.bake_pos_x, context.scene.bake_pos_y, context.scene.bake_pos_z]
+    channels = ''.join([channel for channel, axis in zip('RGB', axes) if axis])
     if high_to_low:
         ob = bpy.data.objects[context.scene.high_poly]
     else:
         ob = bpy.data.objects[context.scene.low_poly]
-    
-    #MATERIAL CONSTRUCTION#
-    pos_mat = bpy.data.materials.new("tmp_pos_mat")
-    pos_mat.use_nodes = True
-    nodes = pos_mat.node_tree.nodes
-    links = pos_mat.node_tree.links
-    out_node = nodes[1]
-    tex_coord_node = nodes.new("ShaderNodeTexCoord")
-    #R(Left-to-right) node
-    if x_axis:
-        mapping_node_R = nodes.new("ShaderNodeMapping")
-        min_vertex_position = abs(min_vertex(ob.data, 'x'))
-        true_scale = 1/ob.dimensions.x
-        mapping_node_R.scale[0] = true_scale
-        mapping_node_R.translation[0] = min_vertex_position * true_scale
-        gradient_node_R = nodes.new("ShaderNodeTexGradient")
-        links.new(tex_coord_node.outputs[3], mapping_node_R.inputs[0])
-        links.new(mapping_node_R.outputs[0], gradient_node_R.inputs[0])
-    #G(Bottom-to-top) node
-    if y_axis:
-        mapping_node_G = nodes.new("ShaderNodeMapping")
-        mapping_node_G.rotation[1] = 1.5708 #Radian rotation of 90 degrees in Y
-        min_vertex_position = abs(min_vertex(ob.data, 'z'))
-        true_scale = 1/ob.dimensions.z
-        mapping_node_G.scale[2] = true_scale
-        mapping_node_G.translation[0] = min_vertex_position * true_scale
-        gradient_node_G = nodes.new("ShaderNodeTexGradient")
-        links.new(tex_coord_node.outputs[3], mapping_node_G.inputs[0])
-        links.new(mapping_node_G.outputs[0], gradient_node_G.inputs[0])
-    #B(Back-to-front) node
-    if z_axis:
-        mapping_node_B = nodes.new("ShaderNodeMapping")
-        mapping_node_B.rotation[2] = 1.5708 #Radian rotation of 90 degrees in Y
-        min_vertex_position = abs(min_vertex(ob.data, 'y'))
-        true_scale = 1/ob.dimensions.y
-        mapping_node_B.scale[1] = true_scale
-        mapping_node_B.translation[0] = min_vertex_position * true_scale
-        gradient_node_B = nodes.new("ShaderNodeTexGradient")
-        links.new(tex_coord_node.outputs[3], mapping_node_B.inputs[0])
-        links.new(mapping_node_B.outputs[0], gradient_node_B.inputs[0])
 
-    
-    combine_RGB = nodes.new("ShaderNodeCombineRGB")
-    img_node = nodes.new("ShaderNodeTexImage")
-    img_node.image = img
-    
-
-    #LINKING#
-    if x_axis and not y_axis and not z_axis:
-        img_node.color_space = 'NONE'
-        links.new(gradient_node_R.outputs[0], combine_RGB.inputs[0])
-        links.new(gradient_node_R.outputs[0], combine_RGB.inputs[1])
-        links.new(gradient_node_R.outputs[0], combine_RGB.inputs[2])
-    elif y_axis and not x_axis and not z_axis:
-        img_node.color_space = 'NONE'
-        links.new(gradient_node_G.outputs[0], combine_RGB.inputs[0])
-        links.new(gradient_node_G.outputs[0], combine_RGB.inputs[1])
-        links.new(gradient_node_G.outputs[0], combine_RGB.inputs[2])
-    elif z_axis and not x_axis and not y_axis:
-        img_node.color_space = 'NONE'
-        links.new(gradient_node_B.outputs[0], combine_RGB.inputs[0])
-        links.new(gradient_node_B.outputs[0], combine_RGB.inputs[1])
-        links.new(gradient_node_B.outputs[0], combine_RGB.inputs[2])
-    else:
-        if x_axis:
-            links.new(gradient_node_R.outputs[0], combine_RGB.inputs[0])
-        if y_axis:
-            links.new(gradient_node_G.outputs[0], combine_RGB.inputs[1])
-        if z_axis:
-            links.new(gradient_node_B.outputs[0], combine_RGB.inputs[2])
-    
-    
+    #MATERIAL CONSTRUCTION#
+    def build(pos_mat):
+        nodes = pos_mat.node_tree.nodes
+        links = pos_mat.node_tree.links
+        out_node = nodes[1]
+        gradients = add_position_gradients(nodes, links, channels)
+        combine_RGB = nodes.new("ShaderNodeCombineRGB")
+        img_node = add_bake_image_node(nodes)
 
-    links.new(combine_RGB.outputs[0], out_node.inputs[0])
+        #LINKING#
+        if len(gradients) == 1:
+            img_node.color_space = 'NONE'
+            gradient = list(gradients.values())[0]
+            for idx in range(3):
+                links.new(gradient, combine_RGB.inputs[idx])
+        else:
+            for channel, gradient in gradients.items():
+                links.new(gradient, combine_RGB.inputs['RGB'.index(channel)])
+        links.new(combine_RGB.outputs[0], out_node.inputs[0])
+    pos_mat = get_bake_mat(('POS', channels), build)
+    update_position_mapping(pos_mat, ob)
+    retarget_bake_mat(pos_mat, img)
 
-    
-    nodes.active = img_node
     #APPLICATION; BAKE; REMOVAL#
     original_mats = apply_bake_material(ob, pos_mat)
-    bpy.ops.object.bake(type='DIFFUSE')
+    yield from run_bake('DIFFUSE', img)
     remove_bake_material(ob, original_mats)
 
-    #MATERIAL DESTRUCTION#
-    #bpy.data.materials.remove(pos_mat, do_unlink=True)
-
 def bake_id(context, img):
     """Method for baking ID map"""
+    if context.scene.id_engine == 'GEOMETRY':
+        return bake_id_geometry(context, img)
     set_temperature(context, 1, 'PATH')
     enable_color_bake_settings()
     scn = context.scene
@@ -483,56 +1342,150 @@ def bake_id(context, img):
         ob = bpy.data.objects[scn.low_poly]
 
     if id_type == 'MAT':
-        if len(ob.material_slots) is 0:
+        if not ob.material_slots:
             print("No materials to create IDs")
             return None
+        def build(id_mat):
+            map_node = add_bake_image_node(id_mat.node_tree.nodes)
+            if not use_rgb:
+                map_node.color_space = 'NONE'
         id_mats = []
         for slot in ob.material_slots:
             if slot.material is not None:
-                id_mat = bpy.data.materials.new('id')
-                id_mat.use_nodes = True
-                map_node = id_mat.node_tree.nodes.new("ShaderNodeTexImage")
-                map_node.image = img
+                id_mat = get_bake_mat(('ID', 'MAT', use_rgb, len(id_mats)), build)
+                retarget_bake_mat(id_mat, img)
                 if use_rgb:
                     col = colorsys.hsv_to_rgb(random.random(), 1.0, 1.0)
                 else:
-                    map_node.color_space = 'NONE'
                     col = colorsys.hsv_to_rgb(0.0, 0.0, random.random())
                 col_node = id_mat.node_tree.nodes['Diffuse BSDF']
                 col_node.inputs[0].default_value = (col[0], col[1], col[2], 1)
-                id_mat.node_tree.nodes.active = map_node
                 id_mats.append(id_mat)
 
         original_mats = apply_bake_material(ob, bake_mat_list=id_mats)
-        bpy.ops.object.bake(type='DIFFUSE')
+        yield from run_bake('DIFFUSE', img)
         remove_bake_material(ob, original_mats)
-        for mat in id_mats:
-            bpy.data.materials.remove(mat, do_unlink=True)
     elif id_type == 'VCOL':
-        vcol_mat = bpy.data.materials.new('vcol')
-        vcol_mat.use_nodes = True
-        nodes = vcol_mat.node_tree.nodes
-        links = vcol_mat.node_tree.links
-        vcol_node = nodes.new("ShaderNodeAttribute")
-        vcol_node.attribute_name = ob.data.vertex_colors[0].name
-        out_node = nodes['Diffuse BSDF']
-        rgb2bw_node = nodes.new("ShaderNodeRGBToBW")
-        if use_rgb:
-            links.new(vcol_node.outputs[0], out_node.inputs[0])
-        else:
-            links.new(vcol_node.outputs[0], rgb2bw_node.inputs[0])
-            links.new(rgb2bw_node.outputs[0], out_node.inputs[0])
-        image_node = nodes.new("ShaderNodeTexImage")
-        image_node.image = img
-        nodes.active = image_node
-        
+        def build(vcol_mat):
+            nodes = vcol_mat.node_tree.nodes
+            links = vcol_mat.node_tree.links
+            vcol_node = nodes.new("ShaderNodeAttribute")
+            vcol_node.name = 'gb_vcol'
+            out_node = nodes['Diffuse BSDF']
+            if use_rgb:
+                links.new(vcol_node.outputs[0], out_node.inputs[0])
+            else:
+                rgb2bw_node = nodes.new("ShaderNodeRGBToBW")
+                links.new(vcol_node.outputs[0], rgb2bw_node.inputs[0])
+                links.new(rgb2bw_node.outputs[0], out_node.inputs[0])
+            add_bake_image_node(nodes)
+        vcol_mat = get_bake_mat(('ID', 'VCOL', use_rgb), build)
+        vcol_mat.node_tree.nodes['gb_vcol'].attribute_name = ob.data.vertex_colors[0].name
+        retarget_bake_mat(vcol_mat, img)
+
         original_mats = apply_bake_material(ob, vcol_mat)
-        bpy.ops.object.bake(type='DIFFUSE')
+        yield from run_bake('DIFFUSE', img)
         remove_bake_material(ob, original_mats)
     else:
         return {'CANCELLED'}
     return {'FINISHED'}
 
+def packable_maps(scn):
+    """Enabled Cycles maps that can share one emission bake, in channel order"""
+    maps = []
+    if scn.gamebake_curvature and scn.curvature_engine == 'CYCLES':
+        maps.append('CURVE')
+    if scn.gamebake_position and scn.position_engine == 'CYCLES':
+        if any_one([scn.bake_pos_x, scn.bake_pos_y, scn.bake_pos_z]):
+            maps.append('POS')
+    if scn.gamebake_id and scn.id_engine == 'CYCLES' and not scn.bake_id_color:
+        maps.append('ID')
+    return maps
+
+def recipe_outputs(scn, recipe):
+    """The map types whose images a recipe produces"""
+    if recipe == 'PACK' and scn.pack_output == 'SPLIT':
+        return packable_maps(scn)
+    elif recipe == 'NORMAL':
+        return normal_outputs(scn)
+    return [recipe]
+
+def bake_packed(context, img):
+    """Bakes curvature, position and ID into the R, G and B channels of img in one pass"""
+    set_temperature(context, 1, 'PATH')
+    scn = context.scene
+    maps = packable_maps(scn)
+    id_type = scn.bake_id_type
+    axes = [scn.bake_pos_x, scn.bake_pos_y, scn.bake_pos_z]
+    pos_channel = ''.join([channel for channel, axis in zip('RGB', axes) if axis])
+    if scn.render.bake.use_selected_to_active:
+        ob = bpy.data.objects[scn.high_poly]
+    else:
+        ob = bpy.data.objects[scn.low_poly]
+    img.colorspace_settings.name = 'Non-Color'
+
+    #MATERIAL CONSTRUCTION#
+    def build(pack_mat):
+        nodes = pack_mat.node_tree.nodes
+        links = pack_mat.node_tree.links
+        out_node = nodes['Material Output']
+        emission_node = nodes.new("ShaderNodeEmission")
+        combine_RGB = nodes.new("ShaderNodeCombineRGB")
+        links.new(combine_RGB.outputs[0], emission_node.inputs[0])
+        links.new(emission_node.outputs[0], out_node.inputs[0])
+        if 'CURVE' in maps:
+            geo_node = nodes.new("ShaderNodeNewGeometry")
+            links.new(geo_node.outputs[7], combine_RGB.inputs[0])
+        if 'POS' in maps:
+            gradients = add_position_gradients(nodes, links, pos_channel)
+            links.new(gradients[pos_channel], combine_RGB.inputs[1])
+        if 'ID' in maps and id_type == 'MAT':
+            value_node = nodes.new("ShaderNodeValue")
+            value_node.name = 'gb_id_value'
+            links.new(value_node.outputs[0], combine_RGB.inputs[2])
+        elif 'ID' in maps:
+            vcol_node = nodes.new("ShaderNodeAttribute")
+            vcol_node.name = 'gb_vcol'
+            rgb2bw_node = nodes.new("ShaderNodeRGBToBW")
+            links.new(vcol_node.outputs[0], rgb2bw_node.inputs[0])
+            links.new(rgb2bw_node.outputs[0], combine_RGB.inputs[2])
+        img_node = add_bake_image_node(nodes)
+        img_node.color_space = 'NONE'
+
+    pack_mats = []
+    for idx in range(max(1, len(ob.material_slots))):
+        pack_mat = get_bake_mat(('PACK', tuple(maps), pos_channel, id_type, idx), build)
+        nodes = pack_mat.node_tree.nodes
+        update_position_mapping(pack_mat, ob)
+        if 'gb_id_value' in nodes:
+            nodes['gb_id_value'].outputs[0].default_value = random.random()
+        if 'gb_vcol' in nodes:
+            nodes['gb_vcol'].attribute_name = ob.data.vertex_colors[0].name
+        retarget_bake_mat(pack_mat, img)
+        pack_mats.append(pack_mat)
+
+    #APPLICATION; BAKE; REMOVAL#
+    original_mats = apply_bake_material(ob, bake_mat_list=pack_mats)
+    yield from run_bake('EMIT', img)
+    remove_bake_material(ob, original_mats)
+
+@traced
+def split_packed(context, ob, img, maps):
+    """Copies the channels of a packed bake into the images of the individual maps"""
+    width, height = img.size
+    buf = image_buffer(img)
+    images = []
+    for idx, (channel, recipe) in enumerate(PACK_CHANNELS):
+        if recipe not in maps:
+            continue
+        map_image = make_image_with_id(context, get_map_name(ob, recipe), width, height, recipe)
+        single = np.empty_like(buf)
+        single[..., :3] = buf[..., idx:idx + 1]
+        single[..., 3] = buf[..., 3]
+        write_pixels(map_image, single)
+        images.append(map_image)
+    return images
+
 def register_recipes():
     scn = bpy.types.Scene
     scn.gamebake_normal = BoolProperty(
@@ -576,15 +1529,609 @@ def unregister_recipes():
     del scn.gamebake_id
 
 ###Recipe helper functions####
+def mesh_bounds(mesh):
+    """Returns the (min, max) vertex coordinates of mesh, cached per mesh datablock"""
+    key = mesh.as_pointer()
+    count = len(mesh.vertices)
+    cached = MESH_BOUNDS.get(key)
+    if cached is not None and cached[0] == count:
+        return cached[1]
+    if count == 0:
+        bounds = (np.zeros(3, dtype=np.float32), np.zeros(3, dtype=np.float32))
+    else:
+        co = np.empty(count * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        co = co.reshape(count, 3)
+        bounds = (co.min(axis=0), co.max(axis=0))
+    MESH_BOUNDS[key] = (count, bounds)
+    return bounds
+
 def min_vertex(mesh, axis):
     """Finds the minimum positioned vertex in mesh given axis"""
-    for i, vt in enumerate(mesh.vertices):
-        v = eval('.'.join(['vt.co', axis]))
-        if i == 0:
-            min = v
-        if v < min:
-            min = v
-    return min
+    return float(mesh_bounds(mesh)[0]['xyz'.index(axis)])
+
+def mesh_digest(ob, scene, cache):
+    """Returns a digest of the evaluated geometry, UVs and materials of ob"""
+    if ob.name in cache:
+        return cache[ob.name]
+    h = hashlib.sha1()
+    me = ob.to_mesh(scene, True, 'RENDER')
+    try:
+        for collection, attr, size, dtype in [
+                (me.vertices, 'co', 3, np.float32),
+                (me.loops, 'vertex_index', 1, np.int32),
+                (me.polygons, 'loop_start', 1, np.int32),
+                (me.polygons, 'material_index', 1, np.int32),
+                (me.polygons, 'use_smooth', 1, np.bool_)]:
+            data = np.empty(len(collection) * size, dtype=dtype)
+            collection.foreach_get(attr, data)
+            h.update(data.tobytes())
+        for layer in me.uv_layers:
+            data = np.empty(len(layer.data) * 2, dtype=np.float32)
+            layer.data.foreach_get('uv', data)
+            h.update(data.tobytes())
+        for layer in me.vertex_colors:
+            data = np.empty(len(layer.data) * 3, dtype=np.float32)
+            layer.data.foreach_get('color', data)
+            h.update(data.tobytes())
+    finally:
+        bpy.data.meshes.remove(me)
+    h.update(np.array(ob.matrix_world, dtype=np.float32).tobytes())
+    h.update(repr([slot.material.name if slot.material else '' for slot in ob.material_slots]).encode())
+    cache[ob.name] = h.digest()
+    return cache[ob.name]
+
+def image_digest(image, cache):
+    """Returns a digest of what a texture holds: its file and the file's modification
+    time, or its pixels while they are edited in memory, generated or packed"""
+    key = ('image', image.name)
+    if key in cache:
+        return cache[key]
+    h = hashlib.sha1(image.name.encode())
+    filepath = bpy.path.abspath(image.filepath_raw)
+    if image.source == 'FILE' and not image.is_dirty and image.packed_file is None and os.path.exists(filepath):
+        h.update(filepath.encode())
+        h.update(repr(os.path.getmtime(filepath)).encode())
+    else:
+        h.update(image_buffer(image).tobytes())
+    cache[key] = h.digest()
+    return cache[key]
+
+def material_digest(mat, cache):
+    """Returns a digest of the node values, links and textures a diffuse bake reads"""
+    h = hashlib.sha1(mat.name.encode())
+    if mat.node_tree is not None:
+        for node in mat.node_tree.nodes:
+            image = getattr(node, 'image', None)
+            if image is not None and image.get('bake_id'):
+                #Bake targets added to the material by update_existing_mat_image_node
+                continue
+            h.update(node.bl_idname.encode())
+            if image is not None:
+                h.update(image_digest(image, cache))
+            for socket in node.inputs:
+                if hasattr(socket, 'default_value'):
+                    value = socket.default_value
+                    h.update(repr(tuple(value) if hasattr(value, '__len__') else value).encode())
+        for link in mat.node_tree.links:
+            h.update('.'.join([link.from_node.name, link.from_socket.identifier,
+                               link.to_node.name, link.to_socket.identifier]).encode())
+    else:
+        h.update(repr(tuple(mat.diffuse_color)).encode())
+    return h.digest()
+
+@traced
+def bake_input_hash(context, recipe, cache):
+    """Hashes everything the output of a recipe depends on"""
+    scn = context.scene
+    cbk = scn.render.bake
+    h = hashlib.sha1(recipe.encode())
+    for prop in COMMON_HASH_PROPS + RECIPE_HASH_PROPS[recipe]:
+        #A scene without a world has no AO distance, hashed as None
+        value = reduce(lambda owner, attr: getattr(owner, attr, None), prop.split('.'), scn)
+        if isinstance(value, set):
+            value = sorted(value)
+        h.update(repr(value).encode())
+    obs = [bpy.data.objects[scn.low_poly]]
+    if cbk.use_selected_to_active:
+        obs.append(bpy.data.objects[scn.high_poly])
+        if cbk.use_cage and cbk.cage_object in bpy.data.objects:
+            obs.append(bpy.data.objects[cbk.cage_object])
+    for ob in obs:
+        h.update(mesh_digest(ob, scn, cache))
+    if recipe == 'DIFFUSE':
+        source = obs[1] if cbk.use_selected_to_active else obs[0]
+        for slot in source.material_slots:
+            if slot.material is not None:
+                h.update(material_digest(slot.material, cache))
+    return h.hexdigest()
+
+def bake_is_current(image, bake_hash, width, height):
+    """True if image already holds a bake of the given inputs"""
+    if image is None or image.get('bake_hash') != bake_hash:
+        return False
+    size = image.get('bake_size', image.size)
+    if size[0] != width or size[1] != height:
+        return False
+    if image.get('bake_file'):
+        #Streamed bakes live on disk, the image only holds a proxy
+        return os.path.exists(image['bake_file'])
+    #Generated images come back blank after a reload unless packed or saved
+    return image.is_dirty or image.packed_file is not None or image.source == 'FILE'
+
+@persistent
+def invalidate_mesh_caches(scene):
+    """Drops cached data for meshes that changed since the last scene update and
+    refreshes the cages of changed lowpolys"""
+    if not bpy.data.objects.is_updated:
+        return
+    for ob in scene.objects:
+        if ob.type == 'MESH' and ob.is_updated_data:
+            MESH_BOUNDS.pop(ob.data.as_pointer(), None)
+        if ob.name in CAGES and (ob.is_updated or ob.is_updated_data) and ob.mode != 'EDIT':
+            cage = bpy.data.objects.get(CAGES[ob.name])
+            if cage is None:
+                del CAGES[ob.name]
+            else:
+                distance = cage.get('gb_cage_distance', scene.cage_distance / 100)
+                if hasattr(distance, 'to_list'):
+                    distance = distance.to_list()
+                update_cage(ob, scene, distance)
+
+@persistent
+def clear_caches(dummy):
+    """Forgets per-file caches when a new .blend is loaded"""
+    MESH_BOUNDS.clear()
+    BAKE_MATERIALS.clear()
+    BAKE_MATERIALS_IN_USE.clear()
+    if SCHEDULER.running:
+        #The modal bake operator died with the old file, its queue won't run again
+        SCHEDULER.cancel()
+        SCHEDULER.stop()
+    invalidate_image_index()
+    APPLIED_SETTINGS.clear()
+    CAGES.clear()
+    for ob in bpy.data.objects:
+        if ob.get('gb_cage_of'):
+            CAGES[ob['gb_cage_of']] = ob.name
+
+def register_handlers():
+    bpy.app.handlers.scene_update_post.append(invalidate_mesh_caches)
+    bpy.app.handlers.load_post.append(clear_caches)
+
+def unregister_handlers():
+    if invalidate_mesh_caches in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.remove(invalidate_mesh_caches)
+    if clear_caches in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(clear_caches)
+    MESH_BOUNDS.clear()
+    CAGES.clear()
+    clear_bake_materials()
+
+##############################
+########### Raster ###########
+##############################
+@traced
+def mesh_arrays(ob, scene):
+    """Returns world space NumPy arrays of the evaluated mesh of ob, triangulated by loops"""
+    me = ob.to_mesh(scene, True, 'RENDER')
+    try:
+        me.calc_normals_split()
+        def read(collection, attr, size, dtype=np.float32):
+            data = np.empty(len(collection) * size, dtype=dtype)
+            collection.foreach_get(attr, data)
+            return data.reshape(-1, size) if size > 1 else data
+        arrays = {
+            'co': read(me.vertices, 'co', 3),
+            'normals': read(me.vertices, 'normal', 3),
+            'edges': read(me.edges, 'vertices', 2, np.int32),
+            'loop_verts': read(me.loops, 'vertex_index', 1, np.int32),
+            'loop_normals': read(me.loops, 'normal', 3),
+            'loop_start': read(me.polygons, 'loop_start', 1, np.int32),
+            'loop_total': read(me.polygons, 'loop_total', 1, np.int32),
+            'material_index': read(me.polygons, 'material_index', 1, np.int32),
+            'uv': read(me.uv_layers.active.data, 'uv', 2) if me.uv_layers.active else None,
+            'vcol': read(me.vertex_colors[0].data, 'color', 3) if len(me.vertex_colors) else None
+        }
+    finally:
+        bpy.data.meshes.remove(me)
+
+    matrix = np.array(ob.matrix_world, dtype=np.float32)
+    normal_matrix = np.linalg.inv(matrix[:3, :3]).T
+    arrays['local_co'] = arrays['co']
+    arrays['local_loop_normals'] = arrays['loop_normals']
+    arrays['co'] = np.dot(arrays['co'], matrix[:3, :3].T) + matrix[:3, 3]
+    for key in ('normals', 'loop_normals'):
+        normals = np.dot(arrays[key], normal_matrix.T)
+        arrays[key] = normals / np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+
+    #Fan triangulation; every triangle is three loop indices
+    counts = np.maximum(arrays['loop_total'] - 2, 0)
+    first = np.repeat(arrays['loop_start'], counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    arrays['tris'] = np.stack([first, first + offsets + 1, first + offsets + 2], axis=1)
+    arrays['tri_polys'] = np.repeat(np.arange(len(counts)), counts)
+    return arrays
+
+def vertex_curvature(arrays):
+    """Per vertex convexity in 0-1 (0.5 is flat), the same measure as Cycles' pointiness"""
+    co = arrays['co']
+    normals = arrays['normals']
+    e0, e1 = arrays['edges'][:, 0], arrays['edges'][:, 1]
+    count = len(co)
+    direction = co[e1] - co[e0]
+    direction /= np.maximum(np.linalg.norm(direction, axis=1), 1e-12)[:, None]
+    angle = np.bincount(e0, (normals[e0] * direction).sum(1), minlength=count)
+    angle += np.bincount(e1, -(normals[e1] * direction).sum(1), minlength=count)
+    neighbours = np.bincount(e0, minlength=count) + np.bincount(e1, minlength=count)
+    curvature = np.arccos(np.clip(angle / np.maximum(neighbours, 1), -1.0, 1.0)) / np.pi
+    #One blur pass over the neighbours, as Cycles does
+    blurred = curvature + np.bincount(e0, curvature[e1], minlength=count)
+    blurred += np.bincount(e1, curvature[e0], minlength=count)
+    return (blurred / (neighbours + 1)).astype(np.float32)
+
+def averaged_normals(co, normals, precision=1e-5):
+    """Vertex normals averaged over all vertices at the same position, so split edges move together"""
+    keys = np.ascontiguousarray(np.round(co / precision).astype(np.int64))
+    keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * 3))).ravel()
+    unique, inverse = np.unique(keys, return_inverse=True)
+    summed = np.stack([np.bincount(inverse, normals[:, axis], minlength=len(unique)) for axis in range(3)], axis=1)
+    summed = summed[inverse]
+    return (summed / np.maximum(np.linalg.norm(summed, axis=1), 1e-12)[:, None]).astype(np.float32)
+
+def uv_texels(uv_tris, width, height):
+    """Rasterizes (n, 3, 2) UV triangles.
+
+    Returns the flat pixel index, triangle index and (n, 3) barycentric
+    coordinates of every texel centre covered by a triangle."""
+    points = uv_tris * (width, height) - 0.5
+    lo = np.clip(np.ceil(points.min(axis=1)), 0, (width - 1, height - 1)).astype(np.int64)
+    hi = np.clip(np.floor(points.max(axis=1)), -1, (width - 1, height - 1)).astype(np.int64)
+    spans = np.maximum(hi - lo + 1, 0)
+    areas = spans[:, 0] * spans[:, 1]
+    ends = np.cumsum(areas)
+    pixels, tris, barys = [], [], []
+    start = 0
+    while start < len(areas):
+        base = ends[start] - areas[start]
+        stop = max(start + 1, np.searchsorted(ends, base + RASTER_CHUNK, side='right'))
+        idx = np.arange(start, stop)
+        tri = np.repeat(idx, areas[idx])
+        local = np.arange(len(tri)) - np.repeat(ends[idx] - areas[idx] - base, areas[idx])
+        x = lo[tri, 0] + local % spans[tri, 0]
+        y = lo[tri, 1] + local // spans[tri, 0]
+        a, b, c = points[tri, 0], points[tri, 1], points[tri, 2]
+        denom = (b[:, 1] - c[:, 1]) * (a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (a[:, 1] - c[:, 1])
+        denom[denom == 0] = np.inf
+        l0 = ((b[:, 1] - c[:, 1]) * (x - c[:, 0]) + (c[:, 0] - b[:, 0]) * (y - c[:, 1])) / denom
+        l1 = ((c[:, 1] - a[:, 1]) * (x - c[:, 0]) + (a[:, 0] - c[:, 0]) * (y - c[:, 1])) / denom
+        l2 = 1.0 - l0 - l1
+        inside = (l0 >= -1e-6) & (l1 >= -1e-6) & (l2 >= -1e-6) & np.isfinite(denom)
+        pixels.append((y * width + x)[inside])
+        tris.append(tri[inside])
+        barys.append(np.stack([l0, l1, l2], axis=1)[inside].astype(np.float32))
+        start = stop
+    if len(pixels) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty((0, 3), np.float32)
+    return np.concatenate(pixels), np.concatenate(tris), np.concatenate(barys)
+
+def lp_texels(lp, width, height):
+    """Texels of the low poly UV layout"""
+    return uv_texels(lp['uv'][lp['tris']], width, height)
+
+def interpolate(corner_values, tri, bary):
+    """Interpolates (n, 3, ...) per triangle corner values at the texels"""
+    values = corner_values[tri]
+    return (values * bary.reshape(bary.shape + (1,) * (values.ndim - 2))).sum(axis=1)
+
+def barycentric(points, a, b, c):
+    """Barycentric coordinates of 3D points on the triangles a, b, c"""
+    v0, v1, v2 = b - a, c - a, points - a
+    d00, d01, d11 = (v0 * v0).sum(1), (v0 * v1).sum(1), (v1 * v1).sum(1)
+    d20, d21 = (v2 * v0).sum(1), (v2 * v1).sum(1)
+    denom = d00 * d11 - d01 * d01
+    denom[denom == 0] = np.inf
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+    return np.stack([1.0 - v - w, v, w], axis=1).astype(np.float32)
+
+def project_texels(lp, tri, bary, hp, distance):
+    """Projects low poly texels onto the high poly along their normals.
+
+    Returns the high poly triangle and barycentrics for every texel, and a
+    mask of the texels that found the high poly."""
+    positions = interpolate(lp['co'][lp['loop_verts'][lp['tris']]], tri, bary)
+    normals = interpolate(lp['loop_normals'][lp['tris']], tri, bary)
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+    hp_tri_verts = hp['loop_verts'][hp['tris']]
+    bvh = BVHTree.FromPolygons(hp['co'].tolist(), hp_tri_verts.tolist())
+
+    hit_tris = np.zeros(len(tri), dtype=np.int64)
+    hit_points = np.zeros((len(tri), 3), dtype=np.float32)
+    hit = np.zeros(len(tri), dtype=bool)
+    for idx in range(len(tri)):
+        position = Vector(positions[idx])
+        normal = Vector(normals[idx])
+        location, normal_hit, index, dist = bvh.ray_cast(position + normal * distance, -normal, distance * 2)
+        if index is None:
+            location, normal_hit, index, dist = bvh.find_nearest(position, distance)
+        if index is not None:
+            hit[idx] = True
+            hit_tris[idx] = index
+            hit_points[idx] = location
+    corners = hp['co'][hp_tri_verts[hit_tris]]
+    hp_bary = barycentric(hit_points, corners[:, 0], corners[:, 1], corners[:, 2])
+    return hit_tris, hp_bary, hit
+
+def cage_distances(lp, hp, scene):
+    """How far each vertex of the evaluated lowpoly must be pushed along its
+    averaged normal for the cage to enclose the highpoly, in lowpoly space.
+
+    Rays are cast out of every vertex and step through the highpoly surfaces
+    to find the outermost one. Vertices without an outward hit only need to
+    reach a surface below them; when there is none either, the projection
+    fails. Returns the distances and a mask of the failed vertices."""
+    me = lp.to_mesh(scene, True, 'RENDER')
+    try:
+        count = len(me.vertices)
+        co = np.empty(count * 3, dtype=np.float32)
+        normals = np.empty(count * 3, dtype=np.float32)
+        me.vertices.foreach_get('co', co)
+        me.vertices.foreach_get('normal', normals)
+    finally:
+        bpy.data.meshes.remove(me)
+    co = co.reshape(-1, 3)
+    normals = averaged_normals(co, normals.reshape(-1, 3))
+
+    hp_arrays = mesh_arrays(hp, scene)
+    to_local = np.linalg.inv(np.array(lp.matrix_world, dtype=np.float32))
+    hp_co = np.dot(hp_arrays['co'], to_local[:3, :3].T) + to_local[:3, 3]
+    bvh = BVHTree.FromPolygons(hp_co.tolist(), hp_arrays['loop_verts'][hp_arrays['tris']].tolist())
+    corners = np.concatenate([co, hp_co])
+    reach = float(np.linalg.norm(corners.max(0) - corners.min(0))) * 0.25
+    step = reach * 1e-5
+
+    distances = np.zeros(count, dtype=np.float32)
+    failed = np.zeros(count, dtype=bool)
+    for start in range(0, count, CAGE_RAY_BATCH):
+        end = min(start + CAGE_RAY_BATCH, count)
+        for idx, origin, normal in zip(range(start, end), co[start:end].tolist(), normals[start:end].tolist()):
+            origin = Vector(origin)
+            normal = Vector(normal)
+            outward = 0.0
+            for layer in range(CAGE_MAX_LAYERS):
+                location, hit_normal, index, dist = bvh.ray_cast(origin + normal * outward, normal, reach - outward)
+                if index is None:
+                    break
+                outward += dist + step
+            if outward > 0.0:
+                distances[idx] = outward
+            elif bvh.ray_cast(origin, -normal, reach)[2] is None:
+                failed[idx] = True
+    return distances, failed
+
+def texels_to_buffer(pixels, values, width, height):
+    """Scatters (n, channels) texel values into a (height, width, 4) buffer and coverage mask"""
+    buf = np.zeros((height * width, 4), dtype=np.float32)
+    channels = values.shape[1]
+    buf[pixels, :channels] = values
+    if channels == 1:
+        buf[pixels, 1:3] = values
+    buf[pixels, 3] = 1.0
+    mask = np.zeros(height * width, dtype=bool)
+    mask[pixels] = True
+    return buf.reshape(height, width, 4), mask.reshape(height, width)
+
+def upsample(buf, width, height, smooth=True):
+    """Resamples buf to (height, width, channels) at pixel centres, bilinear or nearest"""
+    rows, cols = buf.shape[:2]
+    x = (np.arange(width, dtype=np.float32) + 0.5) * cols / width - 0.5
+    y = (np.arange(height, dtype=np.float32) + 0.5) * rows / height - 0.5
+    if not smooth:
+        xi = np.clip(np.round(x).astype(np.int64), 0, cols - 1)
+        yi = np.clip(np.round(y).astype(np.int64), 0, rows - 1)
+        return buf[yi][:, xi]
+    x0 = np.clip(np.floor(x).astype(np.int64), 0, cols - 1)
+    y0 = np.clip(np.floor(y).astype(np.int64), 0, rows - 1)
+    x1 = np.minimum(x0 + 1, cols - 1)
+    y1 = np.minimum(y0 + 1, rows - 1)
+    fx = np.clip(x - x0, 0.0, 1.0)[None, :, None]
+    fy = np.clip(y - y0, 0.0, 1.0)[:, None, None]
+    top = buf[y0][:, x0] * (1 - fx) + buf[y0][:, x1] * fx
+    bottom = buf[y1][:, x0] * (1 - fx) + buf[y1][:, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def dilate(buf, mask, margin):
+    """Grows the covered texels of buf outward by margin pixels, like the bake margin"""
+    mask = mask.copy()
+    for i in range(margin):
+        total = np.zeros_like(buf)
+        count = np.zeros(mask.shape, dtype=np.float32)
+        padded = np.pad(buf * mask[..., None], ((1, 1), (1, 1), (0, 0)), mode='constant')
+        padded_mask = np.pad(mask, 1, mode='constant').astype(np.float32)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                total += padded[dy:dy + mask.shape[0], dx:dx + mask.shape[1]]
+                count += padded_mask[dy:dy + mask.shape[0], dx:dx + mask.shape[1]]
+        grow = ~mask & (count > 0)
+        if not grow.any():
+            break
+        buf[grow] = total[grow] / count[grow][:, None]
+        mask |= grow
+    return buf
+
+@traced
+def coverage_mask(context, ob, width, height):
+    """Boolean (height, width) mask of the texels inside ob's UV islands"""
+    pixels, tri, bary = lp_texels(mesh_arrays(ob, context.scene), width, height)
+    mask = np.zeros(width * height, dtype=bool)
+    mask[pixels] = True
+    return mask.reshape(height, width)
+
+def shifted(padded, dy, dx, shape):
+    return padded[dy:dy + shape[0], dx:dx + shape[1]]
+
+def bilateral_filter(buf, mask, radius, sigma, guide=None):
+    """Edge aware smoothing of the covered texels of buf.
+
+    Neighbours are weighted by distance, by how close their value is and, with
+    a guide of (height, width, 3) normals, by how much their normals agree.
+    Texels outside the mask neither contribute nor change."""
+    height, width = mask.shape
+    pad = ((radius, radius), (radius, radius))
+    rgb = buf[..., :3]
+    value = rgb.mean(axis=2)
+    padded_rgb = np.pad(rgb, pad + ((0, 0),), mode='edge')
+    padded_value = np.pad(value, pad, mode='edge')
+    padded_mask = np.pad(mask, pad, mode='constant').astype(np.float32)
+    if guide is not None:
+        padded_guide = np.pad(guide, pad + ((0, 0),), mode='edge')
+    sigma_spatial = max(radius / 2.0, 0.5)
+    total = np.zeros_like(rgb)
+    weights = np.zeros(mask.shape, dtype=np.float32)
+    for dy in range(2 * radius + 1):
+        for dx in range(2 * radius + 1):
+            distance = (dy - radius) ** 2 + (dx - radius) ** 2
+            weight = np.exp(-distance / (2 * sigma_spatial ** 2)) * shifted(padded_mask, dy, dx, mask.shape)
+            difference = shifted(padded_value, dy, dx, mask.shape) - value
+            weight = weight * np.exp(-difference ** 2 / (2 * sigma ** 2))
+            if guide is not None:
+                agreement = (shifted(padded_guide, dy, dx, mask.shape) * guide).sum(axis=2)
+                weight *= np.clip(agreement, 0.0, 1.0) ** 8
+            total += weight[..., None] * shifted(padded_rgb, dy, dx, mask.shape)
+            weights += weight
+    out = buf.copy()
+    covered = mask & (weights > 0)
+    out[covered, :3] = total[covered] / weights[covered][:, None]
+    return out
+
+@traced
+def denoise_bake(context, ob, img):
+    """Denoises a finished bake inside the UV coverage, guided by the normal bake if there is one"""
+    scn = context.scene
+    width, height = img.size
+    mask = coverage_mask(context, ob, width, height)
+    guide = None
+    normal_image = find_bake_image(get_map_name(ob, 'NORMAL'))
+    if normal_image is not None and tuple(normal_image.size) == (width, height):
+        guide = image_buffer(normal_image)[..., :3] * 2.0 - 1.0
+    buf = bilateral_filter(image_buffer(img), mask, scn.denoise_radius, scn.denoise_sigma, guide)
+    write_pixels(img, dilate(buf, mask, scn.render.bake.margin))
+
+@traced
+def bake_surface_values(context, img, values_for, smooth=True):
+    """Rasterizes per texel values computed by values_for into img.
+
+    values_for(arrays, tri, bary) gets the source mesh arrays (the high poly when
+    baking high to low) and the source triangles and barycentrics per texel.
+    Projection casts one ray per texel from Python, so past PROJECT_RAY_LIMIT
+    texels it runs on a coarser grid whose values are upsampled, bilinear if
+    smooth, else nearest for maps of flat IDs."""
+    scn = context.scene
+    cbk = scn.render.bake
+    width, height = img.size
+    lp = mesh_arrays(bpy.data.objects[scn.low_poly], scn)
+    pixels, tri, bary = lp_texels(lp, width, height)
+    if not cbk.use_selected_to_active:
+        values = values_for(lp, tri, bary)
+        buf, mask = texels_to_buffer(pixels, values.reshape(len(pixels), -1), width, height)
+    else:
+        source = mesh_arrays(bpy.data.objects[scn.high_poly], scn)
+        distance = max(cbk.cage_extrusion, scn.cage_distance / 100)
+        step = int(np.ceil(np.sqrt(len(pixels) / PROJECT_RAY_LIMIT)))
+        if step <= 1:
+            tri, bary, hit = project_texels(lp, tri, bary, source, distance)
+            pixels, tri, bary = pixels[hit], tri[hit], bary[hit]
+            values = values_for(source, tri, bary)
+            buf, mask = texels_to_buffer(pixels, values.reshape(len(pixels), -1), width, height)
+        else:
+            coarse_width, coarse_height = max(1, width // step), max(1, height // step)
+            coarse_pixels, tri, bary = lp_texels(lp, coarse_width, coarse_height)
+            tri, bary, hit = project_texels(lp, tri, bary, source, distance)
+            coarse_pixels, tri, bary = coarse_pixels[hit], tri[hit], bary[hit]
+            values = values_for(source, tri, bary)
+            coarse, coarse_mask = texels_to_buffer(coarse_pixels, values.reshape(len(coarse_pixels), -1),
+                                                   coarse_width, coarse_height)
+            #Island borders of the full map reach past the coarse texels
+            coarse = dilate(coarse, coarse_mask, 2)
+            mask = np.zeros(width * height, dtype=bool)
+            mask[pixels] = True
+            mask = mask.reshape(height, width)
+            buf = upsample(coarse, width, height, smooth)
+            buf[~mask] = 0.0
+            buf[..., 3] = mask
+    if not img.is_float and img.colorspace_settings.name not in {'Non-Color', 'Raw'}:
+        #Cycles stores colour bakes in byte images as sRGB
+        buf[..., :3] = linear_to_srgb(buf[..., :3])
+    write_pixels(img, dilate(buf, mask, cbk.margin))
+
+def bake_curvature_geometry(context, img):
+    """Curvature from vertex convexity, no render pass"""
+    def values_for(arrays, tri, bary):
+        curvature = vertex_curvature(arrays)
+        return interpolate(curvature[arrays['loop_verts'][arrays['tris']]], tri, bary)
+    bake_surface_values(context, img, values_for)
+
+def bake_position_geometry(context, img):
+    """Object space position gradients, matching the node setup of bake_position"""
+    scn = context.scene
+    if scn.render.bake.use_selected_to_active:
+        ob = bpy.data.objects[scn.high_poly]
+    else:
+        ob = bpy.data.objects[scn.low_poly]
+    axes = [scn.bake_pos_x, scn.bake_pos_y, scn.bake_pos_z]
+    channels = ''.join([channel for channel, axis in zip('RGB', axes) if axis])
+    def values_for(arrays, tri, bary):
+        co = interpolate(arrays['local_co'][arrays['loop_verts'][arrays['tris']]], tri, bary)
+        values = np.zeros((len(tri), 3), dtype=np.float32)
+        for channel, axis, rotation in POSITION_CHANNELS:
+            if channel not in channels:
+                continue
+            idx = 'xyz'.index(axis)
+            true_scale = 1/ob.dimensions[idx]
+            offset = abs(min_vertex(ob.data, axis)) * true_scale
+            values[:, 'RGB'.index(channel)] = np.clip(co[:, idx] * true_scale + offset, 0.0, 1.0)
+        if len(channels) == 1:
+            values[:] = values[:, 'RGB'.index(channels)][:, None]
+        return values
+    bake_surface_values(context, img, values_for)
+
+def bake_id_geometry(context, img):
+    """Material or vertex colour IDs, matching the colours of bake_id"""
+    scn = context.scene
+    use_rgb = scn.bake_id_color
+    if scn.render.bake.use_selected_to_active:
+        ob = bpy.data.objects[scn.high_poly]
+    else:
+        ob = bpy.data.objects[scn.low_poly]
+    if scn.bake_id_type == 'MAT':
+        if not ob.material_slots:
+            print("No materials to create IDs")
+            return None
+        if use_rgb:
+            colors = [colorsys.hsv_to_rgb(random.random(), 1.0, 1.0) for slot in ob.material_slots]
+        else:
+            colors = [colorsys.hsv_to_rgb(0.0, 0.0, random.random()) for slot in ob.material_slots]
+        colors = np.array(colors, dtype=np.float32)
+        def values_for(arrays, tri, bary):
+            slots = np.minimum(arrays['material_index'][arrays['tri_polys'][tri]], len(colors) - 1)
+            return colors[slots]
+        smooth = False
+    elif scn.bake_id_type == 'VCOL':
+        if not ob.data.vertex_colors:
+            print("No vertex colors to create IDs")
+            return None
+        def values_for(arrays, tri, bary):
+            values = interpolate(arrays['vcol'][arrays['tris']], tri, bary)
+            if not use_rgb:
+                values = np.dot(values, LUMA)[:, None]
+            return values
+        smooth = True
+    else:
+        return {'CANCELLED'}
+    bake_surface_values(context, img, values_for, smooth)
+    return {'FINISHED'}
+
 
 ##############################
 ######### Interface ##########
@@ -595,6 +2142,7 @@ def draw_bake_menu(context, layout):
     
     row = layout.row()
     draw_bake_button(context, row)
+    draw_batch_settings(context, layout)
     
     row = layout.row()
     col = row.column()
@@ -613,6 +2161,8 @@ def draw_bake_menu(context, layout):
 def draw_overwrite_bakes(context, pos):
     scn = context.scene
     pos.prop(scn, 'overwrite_bakes', icon='GHOST')
+    pos.prop(scn, 'skip_unchanged', icon='FILE_REFRESH')
+    pos.prop(scn, 'trace_bakes', icon='TIME')
 
 def draw_bake_button(context, pos):
     scn = context.scene
@@ -632,12 +2182,25 @@ def draw_bake_button(context, pos):
     else:
             pos.operator("gb.bake", icon='TEXTURE_SHADED')
 
+def draw_batch_settings(context, pos):
+    scn = context.scene
+    row = pos.row(align=True)
+    row.operator("gb.bake_batch", icon='GROUP')
+    row.prop(scn, 'batch_pairing', text="")
+    row = pos.row(align=True)
+    row.prop(scn, 'batch_low_suffix')
+    row.prop(scn, 'batch_high_suffix')
+
 def draw_image_settings(context, pos):
     scn = context.scene
     cbk = scn.render.bake
     pos.prop(cbk, "margin")
     pos.prop(scn, 'bake_width')
     pos.prop(scn, 'bake_height')
+    row = pos.row(align=True)
+    row.prop(scn, 'use_tiled_bake', toggle=True)
+    if scn.use_tiled_bake:
+        row.prop(scn, 'bake_memory_budget', text="MB")
 
 def draw_export_settings(context, pos):
     scn = context.scene
@@ -651,6 +2214,18 @@ def draw_export_settings(context, pos):
         pos.operator('gb.export_bakes', icon='DISK_DRIVE')
         row = pos.row()
         row.prop(scn, 'image_format')
+        row = pos.row(align=True)
+        row.prop(scn, 'extra_image_formats')
+        row = pos.row(align=True)
+        row.prop(scn, 'export_mips', toggle=True)
+        row.prop(scn, 'mip_filter', text="")
+        row = pos.row(align=True)
+        row.prop(scn, 'stream_bakes', toggle=True)
+        row.prop(scn, 'export_channel_pack', toggle=True)
+        if scn.export_channel_pack:
+            row = pos.row(align=True)
+            for prop in CHANNEL_PACK_PROPS:
+                row.prop(scn, prop, text="")
     pos.prop(scn, 'export_dir', text="Export")
 
 
@@ -693,6 +2268,10 @@ def draw_mesh_info_panel(context, pos):
         col.operator("gb.generate_cage", icon='BBOX')
         col = row.column()
         col.prop(scn, 'cage_distance')
+        row = box.row(align=True)
+        row.operator("gb.analyze_cage", icon='VIEWZOOM')
+        row.prop(scn, 'cage_mode', text="")
+        row.prop(scn, 'cage_margin')
 
 def draw_bake_types(context, pos):
     scn = context.scene
@@ -711,18 +2290,41 @@ def draw_bake_types(context, pos):
         box.prop(scn, 'gamebake_ao', icon='DOT')
         if scn.gamebake_ao:
             box.prop(scn, 'ao_quality')
+            row = box.row(align=True)
+            row.prop(scn, 'ao_adaptive', toggle=True)
+            if scn.ao_adaptive:
+                row.prop(scn, 'ao_noise_target')
+                row.prop(scn, 'ao_time_budget')
+            row = box.row(align=True)
+            row.prop(scn, 'denoise_bakes', toggle=True)
+            if scn.denoise_bakes:
+                row.prop(scn, 'denoise_radius')
+                row.prop(scn, 'denoise_sigma')
         box.prop(scn, 'gamebake_normal', icon='DOT')
         if scn.gamebake_normal:
             box.prop(cbk, 'normal_space')
             row = box.row()
             row.prop(scn, 'engine_type')
+            row.prop(scn, 'normal_depth')
+            row = box.row(align=True)
+            row.prop(scn, 'normal_variants')
+            if 'CUSTOM' in scn.normal_variants:
+                row = box.row(align=True)
+                row.prop(scn, 'normal_swizzle_r', text="")
+                row.prop(scn, 'normal_swizzle_g', text="")
+                row.prop(scn, 'normal_swizzle_b', text="")
+            if cbk.normal_space == 'OBJECT':
+                box.prop(scn, 'normal_to_tangent')
         box.prop(scn, 'gamebake_curvature', icon='DOT')
+        if scn.gamebake_curvature:
+            box.prop(scn, 'curvature_engine')
         box.prop(scn, 'gamebake_position', icon='DOT')
         if scn.gamebake_position:
             row = box.row(align=True)
             row.prop(scn, 'bake_pos_x', toggle=True)
             row.prop(scn, 'bake_pos_y', toggle=True)
             row.prop(scn, 'bake_pos_z', toggle=True)
+            box.prop(scn, 'position_engine')
         box.prop(scn, 'gamebake_id', icon='DOT')
         if scn.gamebake_id:
             row = box.row()
@@ -730,47 +2332,33 @@ def draw_bake_types(context, pos):
             col.prop(scn, 'bake_id_type')
             col = row.column()
             col.prop(scn, 'bake_id_color')
+            box.prop(scn, 'id_engine')
+        box.prop(scn, 'pack_grayscale', icon='DOT')
+        if scn.pack_grayscale:
+            box.prop(scn, 'pack_output', expand=True)
 
 def draw_bake_queue(pos):
-    global BAKEIMG
-    global BAKELIST
-    global LASTIMG
-    if BAKEIMG is not None:
-        if BAKEIMG.is_dirty:
-            LASTIMG = None
-    
-    if BAKING or LASTIMG is not None:
-        row = pos.row()
-        row.label("Bake Queue:")
-        row = pos.row()
-        box = row.box()
-        if BAKING:
-            for i in range(len(BAKELIST)):
-                row = box.row()
-                if BAKELIST[i] == 'NORMAL':
-                    ico = 'MATCAP_23'
-                elif BAKELIST[i] == 'CURVE':
-                    ico = 'MATCAP_10'
-                elif BAKELIST[i] == 'DIFFUSE':
-                    ico = 'MATCAP_02'
-                elif BAKELIST[i] == 'AO':
-                    ico = 'MATCAP_09'
-                elif BAKELIST[i] == 'POS':
-                    ico = 'MATCAP_08'
-                elif BAKELIST[i] == 'ID':
-                    ico = 'MATCAP_21'
-                row.label(BAKELIST[i], icon=ico)
-        elif LASTIMG is not None:
-            row = box.row()
-            if LASTIMG == 'NORMAL':
-                ico = 'MATCAP_23'
-            elif LASTIMG == 'DIFFUSE':
-                ico = 'MATCAP_02'
-            elif LASTIMG == 'AO':
-                ico = 'MATCAP_09'
-            row.label(LASTIMG, icon=ico)
-        row = pos.row()
-        row.label("Baking in progress...")
+    if not SCHEDULER.running:
+        return
+    row = pos.row()
+    row.label("Bake Queue: %d/%d" % (SCHEDULER.finished_count(), len(SCHEDULER.jobs)))
+    row.operator('gb.cancel_bake', text="", icon='CANCEL')
+    box = pos.box()
+    for index, job in enumerate(SCHEDULER.jobs):
+        row = box.row(align=True)
+        label = job.recipe
+        if job.started is not None:
+            label = "%s  %s %.1fs" % (job.recipe, job.status.lower(), job.duration())
+        row.label(label, icon=RECIPE_ICONS.get(job.recipe, 'NONE'))
+        if job.status == 'QUEUED':
+            move = row.operator('gb.move_bake_job', text="", icon='TRIA_UP')
+            move.index = index
+            move.offset = -1
+            move = row.operator('gb.move_bake_job', text="", icon='TRIA_DOWN')
+            move.index = index
+            move.offset = 1
+    row = pos.row()
+    row.label("Baking in progress...")
 
 def register_interface():
     scn = bpy.types.Scene
@@ -790,6 +2378,707 @@ def unregister_interface():
     del scn.mesh_info_panel
 
 
+##############################
+########### Export ###########
+##############################
+@traced
+def image_buffer(img):
+    """Returns the pixels of img as a (height, width, 4) float32 array, bottom row first.
+    Before Blender 2.83 pixels has no foreach_get and this copies through a Python tuple."""
+    width, height = img.size
+    buf = np.empty(width * height * 4, dtype=np.float32)
+    try:
+        img.pixels.foreach_get(buf)
+    except AttributeError:
+        buf[:] = img.pixels[:]
+    return buf.reshape(height, width, 4)
+
+@traced
+def write_pixels(img, buf):
+    """Writes a (height, width, 4) float array into img, through a Python sequence
+    before Blender 2.83, which has no pixels.foreach_set"""
+    buf = np.ascontiguousarray(buf, dtype=np.float32).ravel()
+    try:
+        img.pixels.foreach_set(buf)
+    except AttributeError:
+        img.pixels[:] = buf
+    img.update()
+
+def linear_to_srgb(rgb):
+    rgb = np.maximum(rgb, 0.0)
+    return np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.power(rgb, 1 / 2.4) - 0.055)
+
+def srgb_to_linear(rgb):
+    rgb = np.maximum(rgb, 0.0)
+    return np.where(rgb <= 0.04045, rgb / 12.92, np.power((rgb + 0.055) / 1.055, 2.4))
+
+def linear_image_buffer(img, settings):
+    """image_buffer of img in linear values when the file formats encode it as sRGB,
+    so float outputs and mip filtering never work on sRGB encoded bytes"""
+    buf = image_buffer(img)
+    if settings['to_srgb'] and not img.is_float:
+        buf[..., :3] = srgb_to_linear(buf[..., :3])
+    return buf
+
+def quantize(buf, depth):
+    """Returns buf clamped to 0-1 as unsigned integers of the given bit depth"""
+    top = 255 if depth == 8 else 65535
+    dtype = np.uint8 if depth == 8 else np.uint16
+    return (np.clip(buf, 0.0, 1.0) * top + 0.5).astype(dtype)
+
+def format_extension(img_format):
+    if img_format == 'TARGA' or img_format == 'TARGA_RAW':
+        return 'tga'
+    elif img_format == 'JPEG':
+        return 'jpg'
+    elif img_format == 'OPEN_EXR':
+        return 'exr'
+    return img_format.lower()
+
+def export_settings(img):
+    """Returns how the pixels of img are converted for the file formats: the bit depth
+    of its map's precision, a single channel for grayscale maps and the DDS compression"""
+    map_type = img.get('bake_map')
+    is_data = img.colorspace_settings.name in {'Non-Color', 'Raw'} or (
+        map_type is not None and (map_type.startswith('NORMAL') or is_non_color(bpy.context, map_type)))
+    depth = 8
+    channels = 4
+    if map_type is not None:
+        depth = map_precision(map_type)[1] if img.is_float else 8
+        channels = 1 if check_image_grayscale(bpy.context, map_type) else 4
+    if map_type is not None and map_type.startswith('NORMAL'):
+        compression = 'BC5'
+    elif channels == 1:
+        compression = 'BC4'
+    else:
+        compression = 'BC1'
+    return {
+        'to_srgb': not is_data, #Colour pixels are linear on export, see export_buffer
+        'depth': depth,
+        'channels': channels,
+        'compression': compression,
+        'srgb': not is_data,
+        'normals': map_type is not None and map_type.startswith('NORMAL')
+    }
+
+def png_chunk(tag, data):
+    return b''.join([struct.pack('>I', len(data)), tag, data,
+                     struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)])
+
+def write_png(filepath, pixels):
+    """Writes (height, width, channels) uint8/uint16 pixels, bottom row first, as PNG"""
+    height, width, channels = pixels.shape
+    depth = pixels.dtype.itemsize * 8
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    rows = np.ascontiguousarray(pixels[::-1], dtype='>u%d' % pixels.dtype.itemsize)
+    rows = rows.view(np.uint8).reshape(height, -1)
+    #Up filter: every scanline stores its difference to the one above
+    filtered = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+    header = struct.pack('>IIBBBBB', width, height, depth, color_type, 0, 0, 0)
+    with open(filepath, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(png_chunk(b'IHDR', header))
+        f.write(png_chunk(b'IDAT', zlib.compress(filtered.tobytes(), 6)))
+        f.write(png_chunk(b'IEND', b''))
+
+def tga_packets(pixels):
+    """Run length encodes (height, width, channels) uint8 pixels as TGA packets,
+    none of them crossing a row"""
+    height, width, channels = pixels.shape
+    px = pixels.reshape(-1, channels)
+    count = len(px)
+    new_run = np.ones(count, dtype=bool)
+    new_run[1:] = (px[1:] != px[:-1]).any(axis=1)
+    new_run[np.arange(0, count, width)] = True
+    run_start = np.flatnonzero(new_run)
+    run_length = np.diff(np.append(run_start, count))
+    #Runs longer than a packet are split into packets of 128 pixels
+    chunks = (run_length + 127) // 128
+    chunk = np.arange(chunks.sum()) - np.repeat(np.cumsum(chunks) - chunks, chunks)
+    starts = np.repeat(run_start, chunks) + chunk * 128
+    lengths = np.minimum(np.repeat(run_length, chunks) - chunk * 128, 128)
+    repeated = lengths > 1
+    #Neighbouring single pixels of a row share raw packets of up to 128
+    single = starts[~repeated]
+    group_start = np.ones(len(single), dtype=bool)
+    group_start[1:] = (single[1:] != single[:-1] + 1) | (single[1:] % width == 0)
+    first = np.flatnonzero(group_start)
+    within = np.arange(len(single)) - first[np.cumsum(group_start) - 1]
+    raw_first = np.flatnonzero(within % 128 == 0)
+    raw_lengths = np.diff(np.append(raw_first, len(single)))
+
+    starts = np.concatenate([starts[repeated], single[raw_first]])
+    lengths = np.concatenate([lengths[repeated], raw_lengths])
+    rle = np.concatenate([np.ones(repeated.sum(), dtype=bool), np.zeros(len(raw_first), dtype=bool)])
+    order = np.argsort(starts, kind='mergesort')
+    starts, lengths, rle = starts[order], lengths[order], rle[order]
+    sizes = 1 + np.where(rle, channels, lengths * channels)
+    offsets = np.cumsum(sizes) - sizes
+    out = np.empty(sizes.sum(), dtype=np.uint8)
+    out[offsets] = (lengths - 1) | (rle * 128)
+    columns = np.arange(channels)
+    out[(offsets[rle] + 1)[:, None] + columns] = px[starts[rle]]
+    raw_lengths = lengths[~rle]
+    within = np.arange(raw_lengths.sum()) - np.repeat(np.cumsum(raw_lengths) - raw_lengths, raw_lengths)
+    source = np.repeat(starts[~rle], raw_lengths) + within
+    target = np.repeat(offsets[~rle] + 1, raw_lengths) + within * channels
+    out[target[:, None] + columns] = px[source]
+    return out.tobytes()
+
+def write_tga(filepath, pixels, rle=False):
+    """Writes (height, width, channels) uint8 pixels, bottom row first, as TGA,
+    run length encoded if rle"""
+    height, width, channels = pixels.shape
+    if channels == 1:
+        image_type = 3
+        data = pixels
+    else:
+        image_type = 2
+        data = pixels[..., [2, 1, 0, 3][:channels]] #BGR(A)
+    if rle:
+        image_type += 8
+    descriptor = 8 if channels == 4 else 0
+    header = struct.pack('<BBBHHBHHHHBB', 0, 0, image_type, 0, 0, 0, 0, 0,
+                         width, height, channels * 8, descriptor)
+    with open(filepath, 'wb') as f:
+        f.write(header)
+        if rle:
+            f.write(tga_packets(np.ascontiguousarray(data)))
+        else:
+            f.write(np.ascontiguousarray(data).tobytes())
+
+def exr_attribute(name, attr_type, data):
+    return b''.join([name.encode() + b'\0', attr_type.encode() + b'\0',
+                     struct.pack('<i', len(data)), data])
+
+def write_exr(filepath, buf, half=True, channel_names='RGBA'):
+    """Writes (height, width, channels) float pixels, bottom row first, as ZIP compressed EXR"""
+    height, width, channels = buf.shape
+    dtype = np.float16 if half else np.float32
+    pixel_type = 1 if half else 2
+    order = sorted(range(channels), key=lambda idx: channel_names[idx])
+    chlist = b''.join([channel_names[idx].encode() + b'\0' + struct.pack('<iB3xii', pixel_type, 0, 1, 1)
+                       for idx in order]) + b'\0'
+    window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+    header = b''.join([
+        b'\x76\x2f\x31\x01', struct.pack('<i', 2),
+        exr_attribute('channels', 'chlist', chlist),
+        exr_attribute('compression', 'compression', b'\x03'),
+        exr_attribute('dataWindow', 'box2i', window),
+        exr_attribute('displayWindow', 'box2i', window),
+        exr_attribute('lineOrder', 'lineOrder', b'\x00'),
+        exr_attribute('pixelAspectRatio', 'float', struct.pack('<f', 1.0)),
+        exr_attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0.0, 0.0)),
+        exr_attribute('screenWindowWidth', 'float', struct.pack('<f', 1.0)),
+        b'\0'
+    ])
+    #Scanlines are stored top row first, each line holding one run per channel.
+    #Converted a block at a time, so a memory mapped buf is never loaded whole.
+    block_count = (height + 15) // 16
+    offsets = []
+    with open(filepath, 'wb') as f:
+        f.write(header)
+        f.write(bytes(8 * block_count)) #Offset table, filled in once the blocks are written
+        for block in range(block_count):
+            rows = buf[::-1][block * 16:(block + 1) * 16]
+            raw = np.ascontiguousarray(rows[:, :, order].transpose(0, 2, 1), dtype=dtype).view(np.uint8).ravel()
+            #ZIP predictor: interleave the bytes, then delta encode them
+            reordered = np.concatenate([raw[0::2], raw[1::2]]).astype(np.int16)
+            reordered[1:] = (reordered[1:] - reordered[:-1] + 128) & 0xff
+            data = zlib.compress(reordered.astype(np.uint8).tobytes(), 6)
+            if len(data) >= len(raw):
+                data = raw.tobytes()
+            offsets.append(f.tell())
+            f.write(struct.pack('<ii', block * 16, len(data)) + data)
+        f.seek(len(header))
+        f.write(struct.pack('<%dQ' % block_count, *offsets))
+
+DDS_FORMATS = {
+    #Compression: (DXGI format, sRGB DXGI format, bytes per block)
+    'BC1': (71, 72, 8),
+    'BC4': (80, 80, 8),
+    'BC5': (83, 83, 16)
+}
+
+def pixel_blocks(pixels):
+    """Splits (height, width, channels) pixels into (n, 16, channels) 4x4 blocks, row by row,
+    repeating the edge pixels of sizes that aren't a multiple of 4"""
+    height, width, channels = pixels.shape
+    pad_y, pad_x = -height % 4, -width % 4
+    if pad_y or pad_x:
+        pixels = np.pad(pixels, ((0, pad_y), (0, pad_x), (0, 0)), mode='edge')
+    rows, cols = pixels.shape[0] // 4, pixels.shape[1] // 4
+    return pixels.reshape(rows, 4, cols, 4, channels).swapaxes(1, 2).reshape(-1, 16, channels)
+
+def encode_bc4(values):
+    """BC4 blocks of (n, 16) values in 0-1, in the eight value mode"""
+    values = np.clip(values, 0.0, 1.0) * 255.0
+    a0 = np.round(values.max(1)).astype(np.uint8)
+    a1 = np.round(values.min(1)).astype(np.uint8)
+    weights = np.array([0, 7, 1, 2, 3, 4, 5, 6], dtype=np.float32) / 7.0
+    palette = a0[:, None] * (1.0 - weights) + a1[:, None] * weights
+    indices = np.abs(values[:, :, None] - palette[:, None, :]).argmin(2).astype(np.uint64)
+    bits = (indices << (3 * np.arange(16, dtype=np.uint64))).sum(1, dtype=np.uint64)
+    out = np.empty(len(values), dtype=[('a0', 'u1'), ('a1', 'u1'), ('low', '<u4'), ('high', '<u2')])
+    out['a0'] = a0
+    out['a1'] = a1
+    out['low'] = bits & np.uint64(0xffffffff)
+    out['high'] = bits >> np.uint64(32)
+    return out.view(np.uint8).reshape(-1, 8)
+
+def encode_bc1(rgb):
+    """BC1 blocks of (n, 16, 3) colours in 0-1, endpoints on each block's principal axis"""
+    rgb = np.clip(rgb, 0.0, 1.0)
+    mean = rgb.mean(1)
+    centered = rgb - mean[:, None]
+    covariance = np.einsum('nki,nkj->nij', centered, centered)
+    axis = np.ones_like(mean)
+    for i in range(4):
+        axis = np.einsum('nij,nj->ni', covariance, axis)
+        axis /= np.maximum(np.linalg.norm(axis, axis=1), 1e-12)[:, None]
+    projection = np.einsum('nki,ni->nk', centered, axis)
+    scale = np.array([31.0, 63.0, 31.0], dtype=np.float32)
+    ends = [np.round(np.clip(mean + axis * projection.max(1)[:, None], 0.0, 1.0) * scale).astype(np.uint16),
+            np.round(np.clip(mean + axis * projection.min(1)[:, None], 0.0, 1.0) * scale).astype(np.uint16)]
+    c0, c1 = [(end[:, 0] << 11) | (end[:, 1] << 5) | end[:, 2] for end in ends]
+    #The four colour mode needs c0 > c1
+    swap = c0 < c1
+    c0[swap], c1[swap] = c1[swap], c0[swap].copy()
+    e0 = np.where(swap[:, None], ends[1], ends[0]) / scale
+    e1 = np.where(swap[:, None], ends[0], ends[1]) / scale
+    palette = np.stack([e0, e1, (2 * e0 + e1) / 3, (e0 + 2 * e1) / 3], axis=1)
+    distances = ((rgb[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(3)
+    indices = distances.argmin(2).astype(np.uint32)
+    indices[c0 == c1] = 0
+    out = np.empty(len(rgb), dtype=[('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')])
+    out['c0'] = c0
+    out['c1'] = c1
+    out['bits'] = (indices << (2 * np.arange(16, dtype=np.uint32))).sum(1, dtype=np.uint32)
+    return out.view(np.uint8).reshape(-1, 8)
+
+def compress_blocks(blocks, compression):
+    if compression == 'BC1':
+        return encode_bc1(blocks[..., :3])
+    elif compression == 'BC4':
+        return encode_bc4(blocks[..., 0])
+    return np.concatenate([encode_bc4(blocks[..., 0]), encode_bc4(blocks[..., 1])], axis=1)
+
+def compress_level(pixels, compression, threads=1):
+    """Block compresses (height, width, channels) pixels, top row first, in batches"""
+    blocks = pixel_blocks(pixels)
+    batches = [blocks[start:start + DDS_BLOCK_BATCH] for start in range(0, len(blocks), DDS_BLOCK_BATCH)]
+    if threads > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            parts = list(pool.map(lambda batch: compress_blocks(batch, compression), batches))
+    else:
+        parts = [compress_blocks(batch, compression) for batch in batches]
+    return b''.join(part.tobytes() for part in parts)
+
+def filter_weights(mip_filter):
+    """Taps of the 2x downsampling filter and their offsets from the first source texel"""
+    if mip_filter == 'KAISER':
+        #Kaiser windowed sinc over three texels on each side
+        distances = np.arange(-3, 3) + 0.5
+        window = np.i0(MIP_KAISER_ALPHA * np.sqrt(np.maximum(0.0, 1.0 - (distances / 3.0) ** 2)))
+        weights = np.sinc(distances / 2.0) * window
+        return (weights / weights.sum()).astype(np.float32), np.arange(-2, 4)
+    return np.array([0.5, 0.5], dtype=np.float32), np.arange(2)
+
+def downsample(pixels, weights, offsets):
+    """Halves (height, width, channels) pixels with a separable filter, clamping at the
+    edges. Odd sizes round down, as mip levels do."""
+    for axis in (0, 1):
+        size = pixels.shape[axis]
+        if size == 1:
+            continue
+        first = 2 * np.arange(size // 2)
+        pixels = sum(weight * np.take(pixels, np.clip(first + offset, 0, size - 1), axis=axis)
+                     for weight, offset in zip(weights, offsets))
+    return pixels
+
+def mip_levels(buf, mask=None, mip_filter='BOX', normals=False):
+    """The full mip chain of (height, width, channels) linear pixels, down to 1x1.
+
+    With a coverage mask, texels outside the UV islands don't bleed into the
+    covered ones. Normal maps are renormalized at every level."""
+    weights, offsets = filter_weights(mip_filter)
+    levels = [buf]
+    coverage = None if mask is None else mask.astype(np.float32)[..., None]
+    while max(levels[-1].shape[:2]) > 1:
+        level = levels[-1]
+        smaller = downsample(level, weights, offsets)
+        if coverage is not None:
+            covered = downsample(level * coverage, weights, offsets)
+            coverage = downsample(coverage, weights, offsets)
+            inside = coverage > 1e-3
+            smaller = np.where(inside, covered / np.maximum(coverage, 1e-3), smaller)
+            coverage = inside.astype(np.float32)
+        if mip_filter == 'KAISER':
+            smaller = np.clip(smaller, 0.0, 1.0) #The negative lobes ring
+        if normals:
+            vectors = smaller[..., :3] * 2.0 - 1.0
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=2), 1e-6)[..., None]
+            smaller[..., :3] = vectors * 0.5 + 0.5
+        levels.append(smaller.astype(np.float32))
+    return levels
+
+def file_pixels(buf, settings):
+    """The channels of buf written to integer formats, sRGB encoded if needed"""
+    rgb = buf[..., :3]
+    if settings['to_srgb']:
+        rgb = linear_to_srgb(rgb)
+    if settings['channels'] == 1:
+        return rgb[..., :1]
+    return np.concatenate([rgb, buf[..., 3:4]], axis=2)[..., :settings['channels']]
+
+def write_dds(filepath, levels, compression, srgb=False, threads=1):
+    """Writes a mip chain of (height, width, channels) pixels in 0-1, bottom row first,
+    as a block compressed DDS with a DX10 header"""
+    height, width = levels[0].shape[:2]
+    dxgi_format, srgb_format, block_bytes = DDS_FORMATS[compression]
+    flags = 0x1 | 0x2 | 0x4 | 0x1000 | 0x20000 | 0x80000 #Caps, height, width, pixel format, mip count, linear size
+    linear_size = ((width + 3) // 4) * ((height + 3) // 4) * block_bytes
+    pixel_format = struct.pack('<II4sIIIII', 32, 0x4, b'DX10', 0, 0, 0, 0, 0)
+    caps = 0x1000 | 0x8 | 0x400000 #Texture, complex, mipmap
+    header = b''.join([
+        b'DDS ',
+        struct.pack('<7I', 124, flags, height, width, linear_size, 0, len(levels)),
+        struct.pack('<11I', *([0] * 11)),
+        pixel_format,
+        struct.pack('<5I', caps, 0, 0, 0, 0),
+        struct.pack('<5I', srgb_format if srgb else dxgi_format, 3, 0, 1, 0) #2D texture, one element
+    ])
+    with open(filepath, 'wb') as f:
+        f.write(header)
+        for level in levels:
+            f.write(compress_level(np.ascontiguousarray(level[::-1], dtype=np.float32), compression, threads))
+
+def write_level(filepath, img_format, buf, settings):
+    channels = settings['channels']
+    if img_format == 'OPEN_EXR':
+        names = 'Y' if channels == 1 else 'RGBA'[:channels]
+        write_exr(filepath, buf[..., :channels], half=settings['depth'] != 32, channel_names=names)
+    elif img_format == 'PNG':
+        write_png(filepath, quantize(file_pixels(buf, settings), min(settings['depth'], 16)))
+    else:
+        write_tga(filepath, quantize(file_pixels(buf, settings), 8), rle=img_format == 'TARGA')
+
+def mip_path(filepath, level):
+    root, ext = os.path.splitext(filepath)
+    return '%s_mip%d%s' % (root, level, ext)
+
+@traced
+def encode_image(filepath, img_format, buf, settings):
+    """Encodes a pixel buffer from image_buffer() to filepath, with its mip levels in
+    the DDS or as _mipN files when asked. Safe to run off the main thread, returns
+    the written paths."""
+    levels = [buf]
+    if img_format == 'DDS' or settings.get('mips'):
+        levels = mip_levels(buf, settings.get('mask'), settings.get('mip_filter', 'BOX'), settings.get('normals', False))
+    if img_format == 'DDS':
+        write_dds(filepath, [file_pixels(level, settings) for level in levels], settings.get('compression', 'BC1'),
+                  srgb=settings.get('srgb', False) and settings.get('compression') == 'BC1',
+                  threads=settings.get('threads', 1))
+        return [filepath]
+    paths = [filepath] + [mip_path(filepath, idx) for idx in range(1, len(levels))]
+    for path, level in zip(paths, levels):
+        write_level(path, img_format, level, settings)
+    return paths
+
+NATIVE_ENCODERS = {'PNG', 'TARGA', 'TARGA_RAW', 'OPEN_EXR', 'DDS'}
+
+@traced
+def save_with_blender(img, filepath, img_format, settings):
+    """Saves img through Blender's own writers, for the formats we don't encode.
+
+    Single channel maps are written as BW through the scene's render output
+    settings, with a raw view so the data isn't colour managed."""
+    if settings['channels'] != 1:
+        img.file_format = img_format
+        img.filepath_raw = filepath
+        img.save()
+        return
+    scn = bpy.context.scene
+    output = scn.render.image_settings
+    view = scn.view_settings
+    previous = [(owner, attr, getattr(owner, attr)) for owner, attr in [
+        (output, 'file_format'), (output, 'color_mode'), (output, 'color_depth'),
+        (view, 'view_transform'), (view, 'look'), (view, 'exposure'), (view, 'gamma'),
+        (view, 'use_curve_mapping')]]
+    try:
+        output.file_format = img_format
+        output.color_mode = 'BW'
+        if settings['depth'] > 8:
+            try:
+                output.color_depth = '16'
+            except TypeError: #Format without 16 bit output
+                pass
+        view.view_transform = 'Raw'
+        view.look = 'None'
+        view.exposure = 0.0
+        view.gamma = 1.0
+        view.use_curve_mapping = False
+        img.save_render(filepath, scn)
+    finally:
+        for owner, attr, value in previous:
+            try:
+                setattr(owner, attr, value)
+            except TypeError:
+                pass
+
+def channel_pack_groups(scn, images):
+    """Splits off the images that are exported channel packed.
+
+    Returns {output name: [image or None per RGBA channel]} and the other images."""
+    maps = [getattr(scn, prop) for prop in CHANNEL_PACK_PROPS]
+    if not scn.export_channel_pack or all(map_type == 'NONE' for map_type in maps):
+        return OrderedDict(), images
+    groups = OrderedDict()
+    rest = []
+    for img in images:
+        map_type = img.get('bake_map')
+        ob_name = img.get('bake_object')
+        if ob_name is None or map_type not in maps:
+            rest.append(img)
+            continue
+        ob = bpy.data.objects.get(ob_name)
+        name = get_map_name(ob, 'CHANNELS') if ob is not None else '_'.join([ob_name, 'CHANNELS'])
+        channels = groups.setdefault(name, [None] * 4)
+        for idx, channel_map in enumerate(maps):
+            if channel_map == map_type:
+                channels[idx] = img
+    return groups, rest
+
+def merge_channels(channels):
+    """Stacks the first channel of each image into one RGBA buffer and returns it
+    with its export settings. Missing colour channels are black, a missing alpha white.
+    A channel is encoded like the map's own export, so colour maps get the sRGB curve here."""
+    buffers = [None] * len(channels)
+    for idx, img in enumerate(channels):
+        if img is not None:
+            settings = export_settings(img)
+            buffers[idx] = linear_image_buffer(img, settings)
+            if settings['to_srgb']:
+                buffers[idx][..., 0] = linear_to_srgb(buffers[idx][..., 0])
+    shapes = set(buf.shape for buf in buffers if buf is not None)
+    if len(shapes) != 1:
+        raise ValueError("Channel packed maps differ in size")
+    height, width = shapes.pop()[:2]
+    fill = [0.0, 0.0, 0.0, 1.0]
+    merged = np.stack([buf[..., 0] if buf is not None else np.full((height, width), fill[idx], dtype=np.float32)
+                       for idx, buf in enumerate(buffers)], axis=2)
+    depths = [map_precision(img['bake_map'])[1] if img.is_float else 8 for img in channels if img is not None]
+    return merged, {
+        'to_srgb': False,
+        'depth': max(depths),
+        'channels': 4 if channels[3] is not None else 3,
+        'compression': 'BC1', #No alpha in BC1, DDS packs keep RGB
+        'srgb': False
+    }
+
+def buffer_image(name, buf, colorspace='Non-Color'):
+    """Temporary float image holding buf, for Blender's writers"""
+    height, width = buf.shape[:2]
+    img = bpy.data.images.new(name, width, height, alpha=True, float_buffer=True)
+    img.colorspace_settings.name = colorspace
+    write_pixels(img, buf)
+    return img
+
+def mip_mask(img, shape, cache):
+    """UV coverage of the object img was baked from, if it still matches the image"""
+    ob = bpy.data.objects.get(img.get('bake_object', ''))
+    if ob is None or ob.type != 'MESH':
+        return None
+    key = (ob.name, shape[0], shape[1])
+    if key not in cache:
+        try:
+            cache[key] = coverage_mask(bpy.context, ob, shape[1], shape[0])
+        except Exception: #No UVs any more
+            cache[key] = None
+    return cache[key]
+
+def save_mips_with_blender(name, img, buf, filepath, img_format, settings):
+    """Writes the mip levels of buf as _mipN files through Blender's writers"""
+    #Levels hold linear values, Blender encodes them as sRGB if the image was colour
+    colorspace = 'Linear' if settings['to_srgb'] else 'Non-Color'
+    levels = mip_levels(buf, settings.get('mask'), settings['mip_filter'], settings.get('normals', False))
+    paths = []
+    for idx, level in enumerate(levels[1:], 1):
+        temp = buffer_image(name, level, colorspace)
+        try:
+            save_with_blender(temp, mip_path(filepath, idx), img_format, settings)
+        finally:
+            bpy.data.images.remove(temp, do_unlink=True)
+        paths.append(mip_path(filepath, idx))
+    return paths
+
+def export_formats(scn, formats=None):
+    """The formats to export, the scene's by default, one per file extension"""
+    if formats is None:
+        formats = [scn.image_format] + sorted(scn.extra_image_formats)
+    #Formats sharing an extension would write the same file, the first one is kept
+    extensions = set()
+    unique = []
+    for img_format in formats:
+        if format_extension(img_format) not in extensions:
+            extensions.add(format_extension(img_format))
+            unique.append(img_format)
+    return unique
+
+def export_path(scn, name, img_format):
+    return ''.join([scn.export_dir, name, '.', format_extension(img_format)])
+
+class ExportWriter:
+    """Encodes image files on a thread pool and gathers the written paths and errors.
+
+    With a backlog, submitting waits for the oldest file once that many are pending,
+    so at most backlog buffers are held for encoding."""
+    def __init__(self, threads=1, backlog=STREAM_BACKLOG):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.backlog = backlog
+        self.pending = deque()
+        self.written = []
+        self.errors = []
+        self.results = {} #Filepath: error of each collected file, None once written
+        self.watched = OrderedDict()
+
+    def submit(self, filepath, func, *args):
+        while self.backlog is not None and len(self.pending) >= self.backlog:
+            self.collect(*self.pending.popleft())
+        self.pending.append((filepath, self.pool.submit(func, *args)))
+
+    def collect(self, filepath, future):
+        try:
+            self.written += future.result()
+            self.results[filepath] = None
+        except Exception as e:
+            self.errors.append((filepath, str(e)))
+            self.results[filepath] = str(e)
+        self.notify()
+
+    def watch(self, name, filepaths, callback):
+        """Calls callback(written) once every file of filepaths has been collected,
+        with whether all of them were written. Runs on the thread using the writer."""
+        self.watched[name] = (filepaths, callback)
+        self.notify()
+
+    def notify(self):
+        for name, (filepaths, callback) in list(self.watched.items()):
+            if all(filepath in self.results for filepath in filepaths):
+                del self.watched[name]
+                callback(all(self.results[filepath] is None for filepath in filepaths))
+
+    def close(self):
+        """Waits for every pending file, returns the written paths and errors"""
+        while self.pending:
+            self.collect(*self.pending.popleft())
+        self.pool.shutdown()
+        return self.written, self.errors
+
+def export_bakes(scn, images=None, report=None, formats=None, writer=None):
+    """Writes bake images to the export directory, returns the written paths and errors.
+
+    Every image is read once; the file encoding of all formats runs on a thread pool.
+    Given a writer, encoding is left to it and only the files Blender saved are returned."""
+    if images is None:
+        images = bake_images()
+    formats = export_formats(scn, formats)
+    #Streamed images are proxies, their bake is already on disk
+    images = [img for img in images if img.get('bake_id') and not img.get('bake_file')]
+    if writer is None:
+        packs, images = channel_pack_groups(scn, images)
+    else:
+        #Maps are streamed one by one, the other channels of a pack aren't baked yet
+        packs = OrderedDict()
+    #Threads left over for compressing the blocks of one file
+    block_threads = max(1, EXPORT_THREADS // max(1, len(images) + len(packs)))
+    use_mips = scn.export_mips or 'DDS' in formats
+    masks = {}
+    with trace('export', images=len(images), formats=len(formats)):
+        written = []
+        errors = []
+        pool = ExportWriter(EXPORT_THREADS, backlog=None) if writer is None else writer
+        try:
+            def export_buffer(name, img, buf, settings, source):
+                settings = dict(settings, threads=block_threads, mips=scn.export_mips, mip_filter=scn.mip_filter)
+                if use_mips:
+                    settings['mask'] = mip_mask(source, buf.shape, masks)
+                for img_format in formats:
+                    filepath = export_path(scn, name, img_format)
+                    if img_format in NATIVE_ENCODERS:
+                        pool.submit(filepath, encode_image, filepath, img_format, buf, settings)
+                        continue
+                    try:
+                        if img is None:
+                            temp = buffer_image(name, buf)
+                            try:
+                                save_with_blender(temp, filepath, img_format, settings)
+                            finally:
+                                bpy.data.images.remove(temp, do_unlink=True)
+                        else:
+                            save_with_blender(img, filepath, img_format, settings)
+                        written.append(filepath)
+                        if settings['mips']:
+                            written.extend(save_mips_with_blender(name, img, buf, filepath, img_format, settings))
+                    except Exception as e:
+                        errors.append((filepath, str(e)))
+
+            for img in images:
+                try:
+                    settings = export_settings(img)
+                    buf = linear_image_buffer(img, settings)
+                except Exception as e:
+                    errors.append((img.name, str(e)))
+                    continue
+                export_buffer(img.name, img, buf, settings, img)
+            for name, channels in packs.items():
+                try:
+                    buf, settings = merge_channels(channels)
+                except Exception as e:
+                    errors.append((name, str(e)))
+                    continue
+                export_buffer(name, None, buf, settings, next(img for img in channels if img is not None))
+        finally:
+            if writer is None:
+                encoded, failed = pool.close()
+                written += encoded
+                errors += failed
+    for filepath, error in errors:
+        print("Can't export %s: %s" % (filepath, error))
+        if report is not None:
+            report({'WARNING'}, "Can't export %s: %s" % (os.path.basename(filepath), error))
+    return written, errors
+
+def stream_ready(scn):
+    return scn.stream_bakes and scn.export_dir != '' and '//' not in scn.export_dir
+
+def stream_bakes(scn, images, writer, report=None):
+    """Hands finished bakes to the writer and shrinks each image to a proxy of its file
+    once all its files are written, so memory holds the bake in progress and the
+    writer backlog, not every map. An image whose export fails keeps its bake."""
+    images = [img for img in images if img.get('bake_id') and not img.get('bake_file')]
+    written, errors = export_bakes(scn, images, report=report, writer=writer)
+    failed = set(filepath for filepath, error in errors)
+    formats = export_formats(scn)
+    for img in images:
+        filepaths = [export_path(scn, img.name, img_format) for img_format in formats]
+        if img.name in failed or any(filepath in failed for filepath in filepaths):
+            continue
+        def shrink(written, name=img.name, filepath=filepaths[0]):
+            img = bpy.data.images.get(name)
+            if not written or img is None:
+                return
+            img['bake_size'] = list(img.size)
+            img['bake_file'] = filepath
+            img.scale(STREAM_PROXY_SIZE, STREAM_PROXY_SIZE)
+        #Files Blender saved are already written, the encoded ones are still pending
+        writer.watch(img.name, [filepath for filepath, img_format in zip(filepaths, formats)
+                                if img_format in NATIVE_ENCODERS], shrink)
+    return written, errors
+
 ##############################
 ########## Generic ###########
 ##############################
@@ -810,6 +3099,7 @@ def get_active_lowpoly():
         print("No low poly mesh assigned!")
         return None
 
+@traced
 def validate_selection(context):
     lp = context.scene.low_poly
     hp = context.scene.high_poly
@@ -834,6 +3124,116 @@ def validate_selection(context):
         context.scene.objects.active = lp
         return {'FINISHED'}
         
+def check_image_grayscale(context, map_type):
+    if map_type == 'AO' or map_type == 'CURVE':
+        return True
+    elif map_type == 'POS':
+        x_axis = context.scene.bake_pos_x
+        y_axis = context.scene.bake_pos_y
+        z_axis = context.scene.bake_pos_z
+        return any_one([x_axis, y_axis, z_axis])
+    elif map_type == 'ID':
+        return not context.scene.bake_id_color
+    else:
+        return False
+
+def is_non_color(context, map_type):
+    return map_type == 'PACK' or check_image_grayscale(context, map_type)
+
+@traced
+def update_existing_mat_image_node(ob, map_type, bake_image):
+    """Makes bake_image the active image node in every material of ob"""
+    for mat in ob.material_slots:
+        mat = mat.material
+        mat.use_nodes = True
+        img_exists = False
+        coord = 0
+        for node in mat.node_tree.nodes:
+            if node.type == 'TEX_IMAGE':
+                if node.image == bake_image:
+                    img_exists = True
+                    map_node = node
+                    if is_non_color(bpy.context, map_type):
+                        map_node.color_space = 'NONE'
+                    else:
+                        map_node.color_space = 'COLOR'
+                if node.image is None and node.label is not None:
+                    mat.node_tree.nodes.remove(node)
+        if not img_exists:
+            map_node = mat.node_tree.nodes.new("ShaderNodeTexImage")
+            check_pos(mat.node_tree.nodes, 0.0, map_node)
+            if is_non_color(bpy.context, map_type):
+                map_node.color_space = 'NONE'
+            map_node.label = str(map_type)
+            map_node.image = bake_image
+        mat.node_tree.nodes.active = map_node
+
+def bake_map(context, ob, recipe, hash_cache):
+    """Bakes one recipe, returns its images and whether the bake was skipped"""
+    scn = context.scene
+    with trace('bake', object=ob.name, recipe=recipe):
+        outputs = recipe_outputs(scn, recipe)
+        bake_hash = bake_input_hash(context, recipe, hash_cache)
+        if scn.skip_unchanged:
+            images = [find_bake_image(get_map_name(ob, map_type)) for map_type in outputs]
+            if all(bake_is_current(image, bake_hash, scn.bake_width, scn.bake_height) for image in images):
+                return images, True
+        if recipe == 'PACK' and outputs != [recipe]:
+            packed_image = get_img('_'.join([ob.name, recipe]), scn.bake_width, scn.bake_height,
+                                   floatbuffer=map_precision(recipe)[0])
+            update_existing_mat_image_node(ob, recipe, packed_image)
+            yield from bake(context, recipe, packed_image)
+            images = split_packed(context, ob, packed_image, outputs)
+            remove_img(packed_image)
+        else:
+            bake_image = make_image_with_id(context, get_map_name(ob, recipe), scn.bake_width, scn.bake_height, recipe)
+            update_existing_mat_image_node(ob, recipe, bake_image)
+            images = [(yield from bake(context, recipe, bake_image))]
+            if scn.denoise_bakes and recipe in NOISY_MAPS:
+                denoise_bake(context, ob, bake_image)
+            if recipe == 'NORMAL' and len(outputs) > 1:
+                images += normal_variants(context, ob, bake_image, outputs[1:])
+        for image, map_type in zip(images, outputs):
+            image['bake_hash'] = bake_hash
+            image['bake_map'] = map_type
+            image['bake_object'] = ob.name
+        return images, False
+
+def get_bake_list(scn):
+    """Returns the enabled recipes, in the order they are queued"""
+    bake_jobs = {
+        "DIFFUSE":scn.gamebake_diffuse,
+        "AO":scn.gamebake_ao,
+        "NORMAL":scn.gamebake_normal,
+        "CURVE":scn.gamebake_curvature,
+        "POS":scn.gamebake_position,
+        "ID":scn.gamebake_id
+    }
+    bake_list = [job for job in bake_jobs if bake_jobs[job] is True]
+    packed = packable_maps(scn) if scn.pack_grayscale else []
+    if len(packed) > 1:
+        bake_list = [job for job in bake_list if job not in packed] + ['PACK']
+    return bake_list
+
+def check_bake_ready(context):
+    """Selects the bake objects and returns a warning if the scene can't be baked"""
+    scn = context.scene
+    high_to_low = scn.render.bake.use_selected_to_active
+    scn.render.engine = 'CYCLES'
+    validated = validate_selection(context)
+    if validated is None:
+        return "Lowpoly mesh not assigned"
+    Lowpoly = bpy.data.objects[scn.low_poly]
+    if not Lowpoly.data.uv_textures:
+        return "Mesh is missing a UV map"
+    if high_to_low:
+        if scn.high_poly != '':
+            if not bpy.data.objects[scn.high_poly].is_visible(scn):
+                return "High poly mesh not visible!"
+    if Lowpoly.active_material is None:
+        Lowpoly.active_material = get_mat(Lowpoly.name)
+    return None
+
 class PickHighPoly(bpy.types.Operator):
     """Adds active object to HighPoly mesh selection."""
     bl_idname = "gb.pick_hp"
@@ -876,6 +3276,67 @@ class PickCage(bpy.types.Operator):
         context.scene.render.bake.cage_object = context.active_object.name
         return {'FINISHED'}
 
+def get_cage_material():
+    cage_mat = bpy.data.materials.get('CAGE_MAT')
+    if cage_mat is None or not cage_mat.get('cage'):
+        cage_mat = next((mat for mat in bpy.data.materials if mat.get('cage')), None)
+    if cage_mat is None:
+        cage_mat = bpy.data.materials.new('CAGE_MAT')
+        cage_mat.diffuse_color = (1, 0, 0)
+        cage_mat['cage'] = True
+    return cage_mat
+
+def update_cage(lp, scene, distance):
+    """Builds the cage of lp, or moves the vertices of its existing cage in place.
+
+    The cage is the evaluated lowpoly with every vertex pushed distance along
+    its averaged normal, in the lowpoly's local space. distance is one value or
+    one per vertex, as returned by cage_distances()."""
+    me = lp.to_mesh(scene, True, 'RENDER')
+    count = len(me.vertices)
+    co = np.empty(count * 3, dtype=np.float32)
+    normals = np.empty(count * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', co)
+    me.vertices.foreach_get('normal', normals)
+    co = co.reshape(-1, 3)
+    if np.ndim(distance) > 0:
+        distance = np.asarray(distance, dtype=np.float32)
+        if len(distance) != count:
+            #The topology changed since the distances were measured
+            distance = float(distance.max()) if len(distance) else 0.0
+    cage_co = co + averaged_normals(co, normals.reshape(-1, 3)) * np.reshape(distance, (-1, 1))
+
+    cage = bpy.data.objects.get(CAGES.get(lp.name, ''.join([lp.name, '_CAGE'])))
+    if cage is not None and cage.type == 'MESH' and len(cage.data.vertices) == count \
+            and len(cage.data.polygons) == len(me.polygons):
+        bpy.data.meshes.remove(me)
+        cage.data.vertices.foreach_set('co', cage_co.ravel())
+        cage.data.update()
+    else:
+        me.vertices.foreach_set('co', cage_co.ravel())
+        me.polygons.foreach_set('material_index', np.zeros(len(me.polygons), dtype=np.int32))
+        me.materials.clear()
+        me.materials.append(get_cage_material())
+        me.name = ''.join([lp.name, '_CAGE'])
+        if cage is None:
+            cage = bpy.data.objects.new(me.name, me)
+            scene.objects.link(cage)
+        else:
+            old_mesh = cage.data
+            cage.data = me
+            if old_mesh.users == 0:
+                bpy.data.meshes.remove(old_mesh)
+    cage.matrix_world = lp.matrix_world.copy()
+    cage['gb_cage_of'] = lp.name
+    cage['gb_cage_distance'] = distance.tolist() if np.ndim(distance) > 0 else distance
+    CAGES[lp.name] = cage.name
+    return cage
+
+def update_cage_distance(self, context):
+    lp = bpy.data.objects.get(self.low_poly)
+    if lp is not None and lp.name in CAGES and CAGES[lp.name] in bpy.data.objects:
+        update_cage(lp, self, self.cage_distance / 100)
+
 class GenerateCage(bpy.types.Operator):
     bl_idname = "gb.generate_cage"
     bl_label = "Generate Cage"
@@ -886,123 +3347,295 @@ class GenerateCage(bpy.types.Operator):
         return context.scene.low_poly is not ''
 
     def execute(self, context):
-        lp = bpy.data.objects[context.scene.low_poly]
-        lp.select = True
-        context.scene.objects.active = lp
-        bpy.ops.object.duplicate()
-        cage = context.active_object
-
-        cage.name = ''.join([lp.name, '_CAGE'])
-        bpy.ops.object.modifier_add(type='SOLIDIFY')
-        solidify = cage.modifiers[-1]
-        solidify.use_rim_only = True
-        solidify.thickness = -(context.scene.cage_distance/100)
-        solidify.thickness_clamp = 2
-        mdf_len = len(cage.modifiers)
-        for idx, mdf in enumerate(cage.modifiers):
-            if idx == mdf_len-1:
-                bpy.ops.object.modifier_apply(modifier=mdf.name)
-            bpy.ops.object.modifier_remove(modifier=mdf.name)
-        context.scene.render.bake.cage_object = cage.name
-
-        for i in range(len(cage.material_slots)):
-            bpy.ops.object.material_slot_remove()
-
-        cage_mat = None
-        for mat in bpy.data.materials:
-            try:
-                if mat['cage'] == True:
-                    cage_mat = mat
-            except:
-                pass
-        if cage_mat is None:
-            cage_mat = bpy.data.materials.new('CAGE_MAT')
-            cage_mat.diffuse_color = (1, 0, 0)
-            cage_mat['cage'] = True
-        cage.active_material = cage_mat
+        scn = context.scene
+        lp = bpy.data.objects[scn.low_poly]
+        cage = update_cage(lp, scn, scn.cage_distance / 100)
+        scn.render.bake.cage_object = cage.name
         return {'FINISHED'}
 
 
-class Bake(bpy.types.Operator):
-    bl_idname = "gb.bake"
-    bl_label = "Bake"
-    bl_options = {'REGISTER'}
+def mark_projection_failures(lp, failed):
+    """Collects the failed vertices of lp in the GB_PROJECTION_FAIL vertex group"""
+    group = lp.vertex_groups.get('GB_PROJECTION_FAIL')
+    if group is not None:
+        lp.vertex_groups.remove(group)
+    if not failed.any() or len(lp.data.vertices) != len(failed):
+        return
+    group = lp.vertex_groups.new('GB_PROJECTION_FAIL')
+    group.add(np.flatnonzero(failed).tolist(), 1.0, 'REPLACE')
+
+class AnalyzeCage(bpy.types.Operator):
+    """Measure how far the cage must reach to enclose the highpoly, without baking"""
+    bl_idname = "gb.analyze_cage"
+    bl_label = "Analyze Cage"
+    bl_options = {'REGISTER', 'UNDO'}
 
-    bakelist = []
-    bakemap = None
-    #baking = False
+    @classmethod
+    def poll(cls, context):
+        scn = context.scene
+        return scn.low_poly in bpy.data.objects and scn.high_poly in bpy.data.objects
 
-    def get_map_name(self, ob, map_type):   #Check if ob['name'] is set anywhere?
+    def execute(self, context):
+        scn = context.scene
+        cbk = scn.render.bake
+        lp = bpy.data.objects[scn.low_poly]
+        hp = bpy.data.objects[scn.high_poly]
+        distances, failed = cage_distances(lp, hp, scn)
+        distances *= 1.0 + scn.cage_margin
+        tight = float(distances[~failed].max()) if (~failed).any() else 0.0
+        if scn.cage_mode == 'VARYING':
+            distances[failed] = tight
+            cage = update_cage(lp, scn, distances)
+            cbk.cage_object = cage.name
+            cbk.use_cage = True
+        else:
+            scn.cage_distance = tight * 100
+            cbk.cage_extrusion = tight
+        mark_projection_failures(lp, failed)
+        if failed.any():
+            self.report({'WARNING'}, "%d vertices of %s don't project onto %s, see the GB_PROJECTION_FAIL group" % (
+                failed.sum(), lp.name, hp.name))
+        else:
+            self.report({'INFO'}, "Cage distance %.4f" % tight)
+        return {'FINISHED'}
+
+class BakeJob:
+    """One recipe of one lowpoly/highpoly pair waiting in the bake queue"""
+    def __init__(self, recipe, low_poly, high_poly='', selected_to_active=None):
+        self.recipe = recipe
+        self.low_poly = low_poly
+        self.high_poly = high_poly
+        self.selected_to_active = high_poly != '' if selected_to_active is None else selected_to_active
+        self.status = 'QUEUED' #QUEUED, RUNNING, DONE, SKIPPED, FAILED or CANCELLED
+        self.images = []
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def duration(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+class BakeScheduler:
+    """Queue of bake jobs, advanced one step per timer tick by the Bake operator.
+
+    Cycles passes are started asynchronously and the job resumes once its image
+    has been written, so the interface stays responsive during a bake. Jobs can
+    be cancelled or reordered between ticks."""
+    def __init__(self):
+        self.jobs = []
+        self.running = False
+        self.cancelled = False
+        self.hash_cache = {}
+        self.job = None
+        self.steps = None #Bake generator of the running job
+        self.baking = None #Image the running asynchronous Cycles pass writes into
+        self.writer = None
+        self.written = []
+        self.errors = []
+
+    def start(self, jobs, writer=None):
+        """Queues jobs; given a writer, each finished job is streamed to disk"""
+        self.jobs = list(jobs)
+        self.running = True
+        self.cancelled = False
+        self.hash_cache = {}
+        self.job = None
+        self.steps = None
+        self.baking = None
+        self.writer = writer
+        self.written = []
+        self.errors = []
+        APPLIED_SETTINGS.clear()
+
+    def queued(self):
+        return [job for job in self.jobs if job.status == 'QUEUED']
+
+    def finished_count(self):
+        return len([job for job in self.jobs if job.finished is not None])
+
+    def move(self, index, offset):
+        """Swaps a queued job with its neighbour, if that one is still queued too"""
+        other = index + offset
+        if 0 <= index < len(self.jobs) and 0 <= other < len(self.jobs):
+            if self.jobs[index].status == self.jobs[other].status == 'QUEUED':
+                self.jobs[index], self.jobs[other] = self.jobs[other], self.jobs[index]
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run_next(self, context):
+        """Advances the queue by one step, returns the job it finished, if any.
+        Stops the scheduler once the queue is done or cancelled."""
+        if self.steps is not None:
+            if self.baking is not None and not self.baking.is_dirty:
+                return None
+            return self.resume(context)
+        queued = self.queued()
+        if self.cancelled or not queued:
+            self.stop()
+            return None
+        job = queued[0]
+        job.status = 'RUNNING'
+        job.started = time.time()
+        self.job = job
         try:
-            if ob['name']:
-                ob_name = ob['name']
-        except:
-            ob_name = ob.name
-        return ''.join([ob_name, '_', map_type])
+            warning = select_bake_pair(context, job.low_poly, job.high_poly, job.selected_to_active)
+            if warning is not None:
+                raise RuntimeError(warning)
+            ob = bpy.data.objects[job.low_poly]
+            self.steps = bake_map(context, ob, job.recipe, self.hash_cache)
+        except Exception as e:
+            return self.finish(context, 'FAILED', str(e))
+        return self.resume(context)
 
-    def make_image_with_id(self, context, map_name, width, height):
-        bake_image = None
-        for image in bpy.data.images:
+    def resume(self, context):
+        """Runs the job until its next Cycles pass has started, or to its end"""
+        self.baking = None
+        try:
+            bake_type, img = next(self.steps)
+            if img is not None and not img.is_dirty:
+                if 'RUNNING_MODAL' in bpy.ops.object.bake('INVOKE_DEFAULT', type=bake_type):
+                    self.baking = img
+                    return None
+                raise RuntimeError("Cycles bake didn't start")
+            #A dirty image can't show when an asynchronous bake is done, this pass blocks
+            bpy.ops.object.bake(type=bake_type)
+            return None
+        except StopIteration as stop:
+            self.job.images, skipped = stop.value
+            if self.writer is not None:
+                written, errors = stream_bakes(context.scene, self.job.images, self.writer)
+                self.written += written
+                self.errors += errors
+            return self.finish(context, 'SKIPPED' if skipped else 'DONE')
+        except Exception as e:
+            return self.finish(context, 'FAILED', str(e))
+
+    def finish(self, context, status, error=None):
+        job = self.job
+        self.close_steps()
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        print("%s %s: %s in %.1fs" % (job.low_poly, job.recipe, job.status.lower(), job.duration()))
+        return job
+
+    def close_steps(self):
+        """Ends the running bake generator, which restores the materials and images it swapped"""
+        steps, self.steps, self.baking, self.job = self.steps, None, None, None
+        if steps is not None:
             try:
-                if image['bake_id'] == map_name:
-                    if context.scene.overwrite_bakes:
-                        bake_image = replace_img(image, width, height, map_name)
-                    else:
-                        image['bake_id'] = None
-                        floatbuffer = True
-                        if 'NORMAL' in map_name:
-                            floatbuffer = False
-                        bake_image = get_img(map_name, width, height, floatbuffer=floatbuffer, img_id=True)
-            except:
-                pass
-        if bake_image is None:
-            bake_image = get_img(map_name, width, height, floatbuffer=True, img_id=True)
-        #bake_image.pack(as_png=True) #Compresses the results. Packing should be done by the user
-        return bake_image
-
-    def check_image_grayscale(self, context, map_type):
-        if map_type == 'AO' or map_type == 'CURVE':
-            return True
-        elif map_type == 'POS':
-            x_axis = context.scene.bake_pos_x
-            y_axis = context.scene.bake_pos_y
-            z_axis = context.scene.bake_pos_z
-            return any_one([x_axis, y_axis, z_axis])
-        elif map_type == 'ID':
-            return not context.scene.bake_id_color
-        else:
-            return False
+                steps.close()
+            except Exception as e: #Its objects may be gone with a loaded file
+                print("Can't clean up bake: %s" % e)
 
+    def abort(self, context):
+        """Drops the running job, only safe once its Cycles pass is no longer running"""
+        if self.job is not None:
+            self.finish(context, 'CANCELLED')
 
+    def stop(self):
+        if self.job is not None:
+            self.job.status = 'CANCELLED'
+            self.job.finished = time.time()
+        self.close_steps()
+        for job in self.queued():
+            job.status = 'CANCELLED'
+        if self.writer is not None:
+            written, errors = self.writer.close()
+            self.written += written
+            self.errors += errors
+            self.writer = None
+        self.running = False
+        APPLIED_SETTINGS.clear()
 
-    def update_existing_mat_image_node(self, ob, map_type, bake_image):
-        for mat in ob.material_slots:
-            mat = mat.material
-            mat.use_nodes = True
-            img_exists = False
-            coord = 0
-            for node in mat.node_tree.nodes:
-                if node.type == 'TEX_IMAGE':
-                    if node.image == bake_image:
-                        img_exists = True
-                        map_node = node
-                        if self.check_image_grayscale(bpy.context, map_type):
-                            map_node.color_space = 'NONE'
-                        else:
-                            map_node.color_space = 'COLOR'
-                    if node.image is None and node.label is not None:
-                        mat.node_tree.nodes.remove(node)
-            if not img_exists:
-                map_node = mat.node_tree.nodes.new("ShaderNodeTexImage")
-                check_pos(mat.node_tree.nodes, 0.0, map_node)
-                if self.check_image_grayscale(bpy.context, map_type):
-                    map_node.color_space = 'NONE'
-                map_node.label = str(map_type)
-                map_node.image = bake_image
-            mat.node_tree.nodes.active = map_node
+    def summary(self):
+        counts = OrderedDict()
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        total = sum(job.duration() for job in self.jobs)
+        summary = "Baked %d jobs in %.1fs (%s)" % (len(self.jobs), total,
+            ', '.join(["%d %s" % (n, status.lower()) for status, n in counts.items()]))
+        if self.written or self.errors:
+            summary += ", streamed %d files" % len(self.written)
+        return summary
+
+    def report_lines(self):
+        """Time per lowpoly and every failure, for the end of a batch"""
+        times = OrderedDict()
+        for job in self.jobs:
+            times[job.low_poly] = times.get(job.low_poly, 0.0) + job.duration()
+        lines = ["%-32s %8.1fs" % (low_poly, seconds) for low_poly, seconds in times.items()]
+        lines += ["Failed %s %s: %s" % (job.low_poly, job.recipe, job.error)
+                  for job in self.jobs if job.status == 'FAILED']
+        lines += ["Can't export %s: %s" % error for error in self.errors]
+        return lines
+
+SCHEDULER = BakeScheduler()
+
+def select_bake_pair(context, low_poly, high_poly, selected_to_active):
+    """Points the scene at a lowpoly/highpoly pair and selects it for baking,
+    returns a warning if it can't be baked"""
+    scn = context.scene
+    cbk = scn.render.bake
+    cbk.use_selected_to_active = selected_to_active
+    if scn.low_poly != low_poly or scn.high_poly != high_poly:
+        #The cage the user picked is kept for the pair already in the scene
+        scn.low_poly = low_poly
+        scn.high_poly = high_poly
+        cbk.cage_object = CAGES.get(low_poly, '') if CAGES.get(low_poly) in bpy.data.objects else ''
+        cbk.use_cage = cbk.cage_object != ''
+    return check_bake_ready(context)
+
+def find_bake_pairs(scn):
+    """Returns the (lowpoly, highpoly) names to batch bake, paired by name suffix
+    or by group. Lowpolys without a highpoly are paired with ''."""
+    low = scn.batch_low_suffix.lower()
+    high = scn.batch_high_suffix.lower()
+    meshes = [ob for ob in scn.objects if ob.type == 'MESH']
+    pairs = []
+    if scn.batch_pairing == 'NAME':
+        if low == '' or high == '':
+            return pairs
+        highs = {}
+        for ob in meshes:
+            if ob.name.lower().endswith(high):
+                highs[ob.name[:-len(high)].lower()] = ob.name
+        for ob in meshes:
+            if ob.name.lower().endswith(low):
+                pairs.append((ob.name, highs.get(ob.name[:-len(low)].lower(), '')))
+    else:
+        #Each group holds one asset, by suffix or else the least and most detailed meshes
+        for group in bpy.data.groups:
+            members = [ob for ob in group.objects if ob.type == 'MESH' and ob.name in scn.objects]
+            if len(members) == 0:
+                continue
+            by_polys = sorted(members, key=lambda ob: len(ob.data.polygons))
+            lp = next((ob for ob in members if low and ob.name.lower().endswith(low)), by_polys[0])
+            hp = next((ob for ob in members if high and ob.name.lower().endswith(high)), by_polys[-1])
+            pairs.append((lp.name, hp.name if hp is not lp else ''))
+    return sorted(pairs)
+
+def redraw_views(context):
+    for window in context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+class Bake(bpy.types.Operator):
+    bl_idname = "gb.bake"
+    bl_label = "Bake"
+    bl_options = {'REGISTER'}
+
+    _timer = None
+    _last_tick = None
 
     @classmethod
     def poll(cls, context):
+        if SCHEDULER.running:
+            return False
         if context.scene.low_poly is not '':
             ob_name = context.scene.low_poly
             try:
@@ -1017,71 +3650,114 @@ class Bake(bpy.types.Operator):
             return False
 
     def modal(self, context, event):
-        scn = context.scene
-        ob = get_active_lowpoly()
-        tex_width = scn.bake_width
-        tex_height = scn.bake_height
-        global BAKELIST
-        global BAKING
-        if event.type in {'ESC'}:
-            return {'CANCELLED'} 
-        if not BAKING:
-            return {'CANCELLED'}
-        if len(BAKELIST) > 0:
-            bake_image_name = self.get_map_name(ob, BAKELIST[-1])
-            bake_image = self.make_image_with_id(context, bake_image_name, tex_width, tex_height)
-            self.update_existing_mat_image_node(ob, BAKELIST[-1], bake_image)
-            self.bakemap = bake(context, BAKELIST[-1], bake_image)
-            #self.bakemap = get_map_simple(tex_width, tex_height, BAKELIST[-1])
-            BAKELIST.pop()
-            BAKEIMG = self.bakemap
+        if event.type == 'ESC':
+            SCHEDULER.cancel()
+            if SCHEDULER.baking is not None:
+                #Cycles' bake handler takes ESC while its pass runs, so the pass ended without a result
+                SCHEDULER.abort(context)
             return {'RUNNING_MODAL'}
-        else:
-            BAKING = False
-            return {'FINISHED'}
+        #Events don't say which timer fired, only ours moves its own time_duration
+        if event.type != 'TIMER' or self._timer.time_duration == self._last_tick:
+            return {'PASS_THROUGH'}
+        self._last_tick = self._timer.time_duration
+        job = SCHEDULER.run_next(context)
+        redraw_views(context)
+        if not SCHEDULER.running:
+            context.window_manager.event_timer_remove(self._timer)
+            if TRACE_EVENTS is not None:
+                stop_trace(trace_path(context.scene))
+            summary = SCHEDULER.summary()
+            for line in SCHEDULER.report_lines():
+                print(line)
+            print(summary)
+            for filepath, error in SCHEDULER.errors:
+                self.report({'WARNING'}, "Can't export %s: %s" % (os.path.basename(filepath), error))
+            self.report({'INFO'}, summary)
+            return {'CANCELLED'} if SCHEDULER.cancelled else {'FINISHED'}
+        if job is None:
+            return {'RUNNING_MODAL'}
+        if job.status == 'SKIPPED':
+            self.report({'INFO'}, "%s is up to date" % ', '.join([img.name for img in job.images]))
+        elif job.status == 'FAILED':
+            self.report({'ERROR'}, "%s failed: %s" % (job.recipe, job.error))
+        return {'RUNNING_MODAL'}
 
-        
-        
+    def queue_jobs(self, context):
+        scn = context.scene
+        return [BakeJob(recipe, scn.low_poly, scn.high_poly, scn.render.bake.use_selected_to_active)
+                for recipe in get_bake_list(scn)]
 
     def invoke(self, context, event):
-        global LASTIMG
-        LASTIMG = None
         scn = context.scene
-        high_to_low = scn.render.bake.use_selected_to_active
-        scn.render.engine = 'CYCLES'
-        validated = validate_selection(context)
-        if validated is None:
-            self.report({'WARNING'}, "Lowpoly mesh not assigned")
+        warning = self.check_ready(context)
+        if warning is not None:
+            self.report({'WARNING'}, warning)
             return {'CANCELLED'}
-        Lowpoly = bpy.data.objects[scn.low_poly]
-        if len(Lowpoly.data.uv_textures) is 0:
-            self.report({'WARNING'}, "Mesh is missing a UV map")
+        jobs = self.queue_jobs(context)
+        if len(jobs) == 0:
+            self.report({'WARNING'}, "Nothing to bake")
             return {'CANCELLED'}
-        if high_to_low:
-            if scn.high_poly is not '':
-                if not bpy.data.objects[scn.high_poly].is_visible(scn):
-                    self.report({'WARNING'}, "High poly mesh not visible!")
-                    return {'CANCELLED'}
-        if Lowpoly.active_material is None:
-            Lowpoly.active_material = get_mat(Lowpoly.name)
-        global BAKING
-        global BAKELIST
-        BAKING = True
-        self.baking = True
-        bake_jobs = {
-            "DIFFUSE":scn.gamebake_diffuse,
-            "AO":scn.gamebake_ao,
-            "NORMAL":scn.gamebake_normal,
-            "CURVE":scn.gamebake_curvature,
-            "POS":scn.gamebake_position,
-            "ID":scn.gamebake_id
-        }
-        for job in bake_jobs:
-            if bake_jobs[job] is True:
-                BAKELIST.append(job)
-        context.window_manager.modal_handler_add(self)
+        if scn.stream_bakes and not stream_ready(scn):
+            self.report({'WARNING'}, "Streaming needs an absolute export path, bakes stay in memory")
+        SCHEDULER.start(jobs, ExportWriter() if stream_ready(scn) else None)
+        if tracing_requested(scn):
+            start_trace()
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, context.window)
+        self._last_tick = self._timer.time_duration
+        wm.modal_handler_add(self)
         return {'RUNNING_MODAL'}
 
+    def check_ready(self, context):
+        return check_bake_ready(context)
+
+class BakeBatch(Bake):
+    """Bake every lowpoly/highpoly pair found by name suffix or group, one recipe at a time"""
+    bl_idname = "gb.bake_batch"
+    bl_label = "Bake Batch"
+    bl_options = {'REGISTER'}
+
+    @classmethod
+    def poll(cls, context):
+        return not SCHEDULER.running and context.mode == 'OBJECT'
+
+    def check_ready(self, context):
+        return None
+
+    def queue_jobs(self, context):
+        #Grouped by recipe, so each recipe's bake settings are applied once for all pairs
+        pairs = find_bake_pairs(context.scene)
+        return [BakeJob(recipe, low_poly, high_poly)
+                for recipe in get_bake_list(context.scene) for low_poly, high_poly in pairs]
+
+class CancelBake(bpy.types.Operator):
+    """Cancel the bake queue once the current job is done"""
+    bl_idname = "gb.cancel_bake"
+    bl_label = "Cancel Bake"
+    bl_options = {'REGISTER'}
+
+    @classmethod
+    def poll(cls, context):
+        return SCHEDULER.running
+
+    def execute(self, context):
+        SCHEDULER.cancel()
+        return {'FINISHED'}
+
+class MoveBakeJob(bpy.types.Operator):
+    """Move a queued bake job up or down the queue"""
+    bl_idname = "gb.move_bake_job"
+    bl_label = "Move Bake Job"
+    bl_options = {'REGISTER'}
+
+    index = IntProperty()
+    offset = IntProperty(default=1)
+
+    def execute(self, context):
+        SCHEDULER.move(self.index, self.offset)
+        redraw_views(context)
+        return {'FINISHED'}
+
 class PackBakes(bpy.types.Operator):
     """Pack bakes in .blend file as PNG"""
     bl_idname = "gb.pack_bakes"
@@ -1093,12 +3769,10 @@ class PackBakes(bpy.types.Operator):
         return bpy.context.scene.export_dir is ''
 
     def execute(self, context):
-        for img in bpy.data.images:
-            try:
-                if img['bake_id']:
-                    img.pack(as_png=True)
-            except:
-                pass
+        for img in bake_images():
+            #Streamed bakes are on disk, their image is only a proxy
+            if not img.get('bake_file'):
+                img.pack(as_png=True)
         return {'FINISHED'}
 
 class ExportBakes(bpy.types.Operator):
@@ -1113,26 +3787,12 @@ class ExportBakes(bpy.types.Operator):
 
     def execute(self, context):
         scn = context.scene
-        filepath = scn.export_dir
-        img_format = scn.image_format
-        for img in bpy.data.images:
-            try:
-                img_format = scn.image_format
-                if img['bake_id']:
-                    #img.pack(as_png=True)
-                    img.file_format = img_format
-                    if img_format == 'TARGA' or img_format == 'TARGA_RAW':
-                        img_format = 'TGA'
-                    elif img_format == 'JPEG':
-                        img_format = 'JPG'
-                    elif img_format == 'OPEN_EXR':
-                        img_format = 'EXR'
-                    img.filepath_raw = ''.join([filepath, img.name, '.', img_format.lower()])
-                    img.save()
-                    #img.unpack()
-            except:
-                self.report({'WARNING'}, "Can't export!")
-                pass
+        tracing = tracing_requested(scn) and TRACE_EVENTS is None
+        if tracing:
+            start_trace()
+        export_bakes(scn, report=self.report)
+        if tracing:
+            stop_trace(trace_path(scn))
         return {'FINISHED'}
 
 class BakeList(bpy.types.UIList):
@@ -1156,10 +3816,359 @@ class BakeMenu(bpy.types.Panel):
         layout = self.layout
         draw_bake_menu(context, layout)
 
+##############################
+########## Headless ##########
+##############################
+RECIPE_TOGGLES = {
+    'DIFFUSE': 'gamebake_diffuse',
+    'AO': 'gamebake_ao',
+    'NORMAL': 'gamebake_normal',
+    'CURVE': 'gamebake_curvature',
+    'POS': 'gamebake_position',
+    'ID': 'gamebake_id'
+}
+
+def read_manifest(filepath):
+    """Reads a bake manifest and returns its jobs with the defaults merged in"""
+    with open(filepath) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for job in manifest.get('jobs', []):
+        merged = dict(defaults)
+        merged.update(job)
+        settings = dict(defaults.get('settings', {}))
+        settings.update(job.get('settings', {}))
+        merged['settings'] = settings
+        jobs.append(merged)
+    return jobs
+
+def apply_job_settings(scn, job):
+    """Copies a manifest job onto the scene properties the recipes read"""
+    cbk = scn.render.bake
+    scn.low_poly = job['low_poly']
+    scn.high_poly = job.get('high_poly', '')
+    cbk.use_selected_to_active = scn.high_poly != ''
+    cbk.cage_object = job.get('cage', '')
+    cbk.use_cage = cbk.cage_object != ''
+    scn.bake_width = job.get('width', scn.bake_width)
+    scn.bake_height = job.get('height', scn.bake_height)
+    if 'margin' in job:
+        cbk.margin = job['margin']
+    maps = job.get('maps', [])
+    for recipe, toggle in RECIPE_TOGGLES.items():
+        setattr(scn, toggle, recipe in maps)
+    for prop, value in job['settings'].items():
+        setattr(scn, prop, value)
+    if job.get('export_dir'):
+        scn.export_dir = job['export_dir']
+    if scn.export_dir != '':
+        #The .blend's own export_dir may be relative to it, like a manifest's
+        scn.export_dir = os.path.join(bpy.path.abspath(scn.export_dir), '')
+    if job.get('image_format'):
+        scn.image_format = job['image_format']
+    if job.get('threads'):
+        scn.render.threads_mode = 'FIXED'
+        scn.render.threads = job['threads']
+
+def bake_job(context, job):
+    """Bakes and exports every map of a manifest job without any UI"""
+    result = {
+        'low_poly': job.get('low_poly'),
+        'maps': {},
+        'written': [],
+        'error': None
+    }
+    blend = job.get('blend')
+    if blend and bpy.path.abspath(blend) != bpy.data.filepath:
+        bpy.ops.wm.open_mainfile(filepath=blend)
+        context = bpy.context
+    scn = context.scene
+    try:
+        apply_job_settings(scn, job)
+        warning = check_bake_ready(context)
+        if warning is not None:
+            result['error'] = warning
+            return result
+        if scn.export_dir == '':
+            result['error'] = "No export_dir for job"
+            return result
+        if '//' in scn.export_dir:
+            result['error'] = "export_dir %s is relative to an unsaved .blend" % scn.export_dir
+            return result
+        ob = get_active_lowpoly()
+        images = []
+        errors = []
+        hash_cache = {}
+        writer = ExportWriter() if stream_ready(scn) else None
+        try:
+            for recipe in get_bake_list(scn):
+                start = time.time()
+                bake_images, skipped = run_blocking(bake_map(context, ob, recipe, hash_cache))
+                result['maps'][recipe] = 0.0 if skipped else time.time() - start
+                if writer is None:
+                    images.extend(bake_images)
+                    continue
+                written, failed = stream_bakes(scn, bake_images, writer)
+                result['written'] += written
+                errors += failed
+        finally:
+            if writer is not None:
+                written, failed = writer.close()
+                result['written'] += written
+                errors += failed
+        if writer is None:
+            result['written'], errors = export_bakes(scn, images)
+        if len(errors) > 0:
+            result['error'] = '; '.join(["Can't export %s: %s" % error for error in errors])
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def run_manifest(filepath):
+    """Bakes every job in the manifest and returns one result per job"""
+    results = []
+    jobs = read_manifest(filepath)
+    APPLIED_SETTINGS.clear()
+    tracing = bool(os.environ.get('GB_TRACE')) or any(job['settings'].get('trace_bakes') for job in jobs)
+    if tracing:
+        start_trace()
+    for job in jobs:
+        result = bake_job(bpy.context, job)
+        results.append(result)
+        if result['error'] is None:
+            print("Baked %s: %s" % (result['low_poly'], ', '.join(
+                "%s %.2fs" % (recipe, t) for recipe, t in result['maps'].items())))
+        else:
+            print("Failed %s: %s" % (result['low_poly'], result['error']))
+    if tracing:
+        stop_trace(trace_path(bpy.context.scene))
+    return results
+
+def split_jobs(jobs, workers):
+    """Spreads jobs over the workers, largest first, by baked pixel count"""
+    chunks = [[] for i in range(workers)]
+    loads = [0] * workers
+    def cost(job):
+        return job.get('width', 512) * job.get('height', 512) * max(1, len(job.get('maps', [])))
+    for job in sorted(jobs, key=cost, reverse=True):
+        idx = loads.index(min(loads))
+        chunks[idx].append(job)
+        loads[idx] += cost(job)
+    return [chunk for chunk in chunks if len(chunk) > 0]
+
+def run_farm(filepath, workers):
+    """Bakes the manifest in parallel background Blender processes and gathers one report"""
+    start = time.time()
+    jobs = read_manifest(filepath)
+    chunks = split_jobs(jobs, workers)
+    threads = max(1, (os.cpu_count() or 1) // max(1, len(chunks)))
+    blend = bpy.data.filepath
+    tmp_dir = tempfile.mkdtemp(prefix='game_baker_')
+    procs = []
+    for idx, chunk in enumerate(chunks):
+        for job in chunk:
+            job['threads'] = threads
+        chunk_path = os.path.join(tmp_dir, 'chunk_%d.json' % idx)
+        report_path = os.path.join(tmp_dir, 'report_%d.json' % idx)
+        log_path = os.path.join(tmp_dir, 'worker_%d.log' % idx)
+        with open(chunk_path, 'w') as f:
+            json.dump({'jobs': chunk}, f)
+        cmd = [bpy.app.binary_path, '-b']
+        if blend:
+            cmd.append(blend)
+        cmd += ['-P', os.path.abspath(__file__), '--', chunk_path, '--report', report_path]
+        log = open(log_path, 'w')
+        procs.append((subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log, chunk, report_path, log_path))
+
+    results = []
+    for proc, log, chunk, report_path, log_path in procs:
+        returncode = proc.wait()
+        log.close()
+        try:
+            with open(report_path) as f:
+                results.extend(json.load(f)['results'])
+        except (IOError, ValueError):
+            for job in chunk:
+                results.append({
+                    'low_poly': job.get('low_poly'),
+                    'maps': {},
+                    'written': [],
+                    'error': "Worker exited with code %d, see %s" % (returncode, log_path)
+                })
+    return {
+        'workers': len(chunks),
+        'threads': threads,
+        'elapsed': time.time() - start,
+        'results': results,
+        'failures': [result for result in results if result['error'] is not None]
+    }
+
+BENCHMARK_MESHES = [(16, 3), (32, 5), (64, 6)] #Lowpoly UV sphere segments, highpoly icosphere subdivisions
+BENCHMARK_RESOLUTIONS = [512, 2048]
+BENCHMARK_RECIPES = ['DIFFUSE', 'AO', 'NORMAL', 'CURVE', 'POS', 'ID']
+BENCHMARK_TOLERANCE = 0.15
+BENCHMARK_NOISE_FLOOR = 0.005 #Seconds, smaller differences are never regressions
+
+def timed(func, *args, **kwargs):
+    """Calls func and returns its result and the wall time it took"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def make_benchmark_pair(context, segments, subdivisions):
+    """Adds a UV mapped lowpoly sphere and a bumpy highpoly sphere around it"""
+    bpy.ops.mesh.primitive_uv_sphere_add(segments=segments, ring_count=segments // 2, calc_uvs=True)
+    lp = context.active_object
+    lp.name = 'gb_bench_low'
+    bpy.ops.mesh.primitive_ico_sphere_add(subdivisions=subdivisions, size=1.0)
+    hp = context.active_object
+    hp.name = 'gb_bench_high'
+    co = np.empty(len(hp.data.vertices) * 3, dtype=np.float32)
+    hp.data.vertices.foreach_get('co', co)
+    co = co.reshape(-1, 3)
+    co *= (1.0 + 0.03 * np.sin(co[:, 0] * 23.0) * np.sin(co[:, 1] * 17.0) * np.sin(co[:, 2] * 19.0))[:, None]
+    hp.data.vertices.foreach_set('co', co.ravel())
+    hp.data.update()
+    return lp, hp
+
+def benchmark_pair(context, lp, hp, resolution, export_dir):
+    """Times every stage of baking and exporting one lowpoly/highpoly pair"""
+    scn = context.scene
+    timings = OrderedDict()
+    scn.low_poly = lp.name
+    scn.high_poly = hp.name
+    scn.render.bake.use_selected_to_active = True
+    scn.render.bake.cage_object = ''
+    scn.bake_width = scn.bake_height = resolution
+    scn.overwrite_bakes = True
+    scn.skip_unchanged = False
+    scn.export_dir = export_dir
+    warning = check_bake_ready(context)
+    if warning is not None:
+        raise RuntimeError(warning)
+    images = []
+    timings['make_image_with_id'] = 0.0
+    for recipe in BENCHMARK_RECIPES:
+        img, seconds = timed(make_image_with_id, context, get_map_name(lp, recipe), resolution, resolution, recipe)
+        timings['make_image_with_id'] += seconds
+        update_existing_mat_image_node(lp, recipe, img)
+        validate_selection(context)
+        img, timings[recipe] = timed(run_blocking, bake_recipe(context, recipe, img))
+        images.append(img)
+    MESH_BOUNDS.clear()
+    value, timings['min_vertex'] = timed(min_vertex, hp.data, 'z')
+    bpy.ops.object.select_all(action='DESELECT')
+    value, timings['GenerateCage'] = timed(bpy.ops.gb.generate_cage)
+    cage = bpy.data.objects.get(scn.render.bake.cage_object)
+    if cage is not None:
+        scn.render.bake.cage_object = ''
+        bpy.data.objects.remove(cage, do_unlink=True)
+    (written, errors), timings['export'] = timed(export_bakes, scn, images)
+    for img in images:
+        remove_img(img)
+    return timings
+
+def run_benchmark():
+    """Bakes synthetic meshes at increasing polygon counts and resolutions, returns the timings"""
+    bpy.ops.wm.read_factory_settings()
+    context = bpy.context
+    scn = context.scene
+    for ob in list(scn.objects):
+        bpy.data.objects.remove(ob, do_unlink=True)
+    export_dir = os.path.join(tempfile.mkdtemp(prefix='game_baker_bench_'), '')
+    results = OrderedDict()
+    for segments, subdivisions in BENCHMARK_MESHES:
+        lp, hp = make_benchmark_pair(context, segments, subdivisions)
+        for resolution in BENCHMARK_RESOLUTIONS:
+            case = 'lp%d_hp%d_%dpx' % (len(lp.data.polygons), len(hp.data.polygons), resolution)
+            for stage, seconds in benchmark_pair(context, lp, hp, resolution, export_dir).items():
+                results['/'.join([case, stage])] = seconds
+                print("%-40s %8.3fs" % ('/'.join([case, stage]), seconds))
+        for ob in (lp, hp):
+            bpy.data.objects.remove(ob, do_unlink=True)
+    return {
+        'blender': bpy.app.version_string,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results
+    }
+
+def compare_benchmark(results, baseline, tolerance):
+    """Returns the stages that got slower than the baseline by more than tolerance"""
+    regressions = []
+    for key, seconds in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if seconds > before * (1.0 + tolerance) and seconds - before > BENCHMARK_NOISE_FLOOR:
+            regressions.append((key, before, seconds))
+    return regressions
+
+def main(argv):
+    """Entry point for: blender -b -P game_baker.py -- manifest.json [--workers N]
+    or: blender -b -P game_baker.py -- --benchmark out.json [--baseline old.json]"""
+    if '--' not in argv:
+        return
+    parser = argparse.ArgumentParser(prog='game_baker.py')
+    parser.add_argument('manifest', nargs='?')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Bake in N background Blender processes")
+    parser.add_argument('--report', default='',
+                        help="Write the results as JSON to this path")
+    parser.add_argument('--benchmark', default='',
+                        help="Time the bake stages on synthetic meshes, write the timings to this path")
+    parser.add_argument('--baseline', default='',
+                        help="Flag benchmark stages slower than in this earlier benchmark")
+    parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE,
+                        help="Relative slowdown allowed before a stage counts as a regression")
+    args = parser.parse_args(argv[argv.index('--') + 1:])
+
+    if args.benchmark:
+        report = run_benchmark()
+        with open(args.benchmark, 'w') as f:
+            json.dump(report, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+            regressions = compare_benchmark(report['results'], baseline, args.tolerance)
+            for key, before, seconds in regressions:
+                print("Regression %s: %.3fs -> %.3fs (%+.0f%%)" % (key, before, seconds, 100.0 * (seconds / before - 1)))
+            if len(regressions) > 0:
+                sys.exit(1)
+            print("No regressions against %s" % args.baseline)
+        return
+    if args.manifest is None:
+        parser.error("a manifest or --benchmark is required")
+
+    if args.workers > 0:
+        report = run_farm(args.manifest, args.workers)
+        print("Baked %d jobs on %d workers x %d threads in %.1fs, %d failed" % (
+            len(report['results']), report['workers'], report['threads'],
+            report['elapsed'], len(report['failures'])))
+        for failure in report['failures']:
+            print("Failed %s: %s" % (failure['low_poly'], failure['error']))
+    else:
+        results = run_manifest(args.manifest)
+        report = {
+            'results': results,
+            'failures': [result for result in results if result['error'] is not None]
+        }
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    if len(report['failures']) > 0:
+        sys.exit(1)
+
 classes = [
     BakeMenu,
     Bake,
+    BakeBatch,
+    CancelBake,
+    MoveBakeJob,
     GenerateCage,
+    AnalyzeCage,
     PickHighPoly,
     PickLowPoly,
     PickCage,
@@ -1175,6 +4184,7 @@ def register():
     register_ingredients()
     register_interface()
     register_recipes()
+    register_handlers()
 
 def unregister():
     for cls in classes:
@@ -1184,6 +4194,8 @@ def unregister():
     unregister_ingredients()
     unregister_interface()
     unregister_recipes()
+    unregister_handlers()
 
 if __name__ == '__main__':
     register()
+    main(sys.argv)